@@ -21,15 +21,17 @@ V3.0 re-write of clarityBridge using TOML config files and some tidy up
 
 """
 import requests
-import json
 from datetime import datetime, timedelta,tzinfo
 from dateutil.parser import *
 import paho.mqtt.client as paho
 import time
+import threading
 import sys
 import logging
 import os
 import toml
+import logHelper    # from the Shared folder
+import jsonCodec    # from the Shared folder
 
 VERSION="3.0"   # used for logging
 print("running on python ",sys.version[0])
@@ -52,7 +54,7 @@ try:
         pidFile = config["settings"]["pidfile"]
 
     # logging
-    logging.basicConfig(filename=logFile, format='%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', level=logging.DEBUG)
+    logHelper.setup(logFile, '%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', shared.get("logging"))
     logging.info("############################### ")
     logging.info(f"Starting connexin clarity sensor data collector Vsn: {VERSION}")
 
@@ -116,6 +118,7 @@ ch_data = {}
 mqttc = paho.Client()   # uses a random client id
 dataPublished=False     # flag to wait for publish to complete
 brokerConnected=False   # flag to show the connection succeeded
+connectEvent=threading.Event()  # set by on_connect()
 
 # for checking that the data is new
 lastTimestamp=None # set by getLastTimestamp()
@@ -268,6 +271,7 @@ def on_connect(client, obj, flags, rc):
         logging.info("Connected to broker ok")
     else:
         logging.info("Failed to connect to broker rc: %s", rc)
+    connectEvent.set()  # wake connectToBroker()
 
 def connectToBroker():
 
@@ -284,11 +288,14 @@ def connectToBroker():
 
         # wait for a connection callback
         # the callback publishes the ch_data
-        start = time.time()
+        # a refused connection (rc!=0) is retried by paho so keep waiting
+        deadline = time.time() + mqttConnectTimeout
         while not brokerConnected:
-            if (time.time() - start) > mqttConnectTimeout:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not connectEvent.wait(remaining):
                 logging.error(f"Unable to connect to broker in {mqttConnectTimeout} s")
                 return False
+            connectEvent.clear()
         logging.info("Connected to broker ok")
         return True
 
@@ -301,7 +308,7 @@ def sendToBroker():
 
     dataPublished = False
     logging.info("Sending to broker.")
-    jsonPayload = json.dumps(ch_data)
+    jsonPayload = jsonCodec.dumps(ch_data)
 
     # debugging
     if not debug:
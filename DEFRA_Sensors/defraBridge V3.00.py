@@ -36,9 +36,10 @@ import mysql.connector
 import paho.mqtt.client as paho
 import sys
 import time
-import json
 import os
 import toml
+import logHelper	# from the Shared folder
+import jsonCodec	# from the Shared folder
 
 VERSION="3.00"
 print("running on python ",sys.version[0])
@@ -63,7 +64,7 @@ try:
 
 
 	# logging
-	logging.basicConfig(filename=logFile,format='%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s',level=logging.DEBUG)
+	logHelper.setup(logFile,'%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s',shared.get("logging"))
 	logging.info("############################### ")
 	logging.info(f"Starting DEFRA sensor data collector Vsn: {VERSION}")
 
@@ -268,7 +269,7 @@ print("Sending data")
 for dev in deviceData:
 	# do this in increasing timestamp order
 	for ts in sorted(deviceData[dev]):
-		value=json.dumps(deviceData[dev][ts])
+		value=jsonCodec.dumps(deviceData[dev][ts])
 		logging.info(f"json: {value}")
 		if not debug:
 			mqttc.publish(mqttTopic,value)
@@ -20,6 +20,7 @@ import logging
 import os
 import toml
 import sys
+import logHelper	# from the Shared folder
 
 VERSION="3.00"
 
@@ -45,7 +46,7 @@ try:
 	daysSinceLastSeen = config["settings"]["daysSinceLastSeen"]
 
 	# logging
-	logging.basicConfig(filename=logFile, format='%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', level=logging.DEBUG)
+	logHelper.setup(logFile, '%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', shared.get("logging"))
 	logging.info("############################### ")
 	logging.info(f"Starting device checker Vsn: {VERSION}")
 
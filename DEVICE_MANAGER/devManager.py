@@ -17,15 +17,19 @@ The message and reply are json strings (See devProcessor.py
 
 """
 
-import json
 import paho.mqtt.client as paho
 import mysql.connector
 import time
+import threading
 import logging
 import sys
+import os
+import toml
 import devProcessor
+import logHelper    # from the Shared folder
 
 logFile="/var/log/devManager.log"
+sharedFile="Shared.toml"    # only [logging] is used, if there is no Shared.toml everything is logged
 
 mqttBroker =        'broker' # PINAT test'51.140.15.143'    'mqtt.connectedhumber.org'
 mqttClientUser =    "clientname"
@@ -45,7 +49,8 @@ dbName="aq_db"
 
 msgHandler=None         # here to keep PyCharm happy
 # initialise logging
-logging.basicConfig(filename=logFile,format='%(asctime)s %(message)s', level=logging.DEBUG)
+loggingSettings=toml.load(sharedFile).get("logging") if os.path.exists(sharedFile) else None
+logHelper.setup(logFile,'%(asctime)s %(message)s',loggingSettings)
 
 # initialise job queing
 if int(sys.version[0])>=3:
@@ -55,6 +60,9 @@ else:
 
 job_queue=queue.Queue(MAX_JOBS)
 
+brokerConnected=False
+connectEvent=threading.Event()  # set by on_connect(), see connectToBroker()
+
 
 ############################################################################
 #
@@ -82,18 +90,19 @@ def on_connect(mqttc, obj, flags, rc):
     else:
         brokerConnected=False
         logging.info("on_connect(): callback error rc=%s",str(rc))
+    connectEvent.set()  # wake connectToBroker()
 
 ################################
 #
 # on_message() MQTT broker callback
 #
-# UTF-8 decode the payload and add it to the job queue see main()
+# add the payload bytes to the job queue see main(), jsonCodec decodes them
 # jobs are processed in the order received
 #
 def on_message(mqttc, obj, msg):
     global job_queue,logging
     logging.info("on_message() received payload=%s",msg.payload)
-    job_queue.put(msg.payload.decode("UTF-8"))
+    job_queue.put(msg.payload)
 
 ################################
 #
@@ -135,14 +144,20 @@ def connectToBroker():
     # terminate if the connection takes too long
     # on_connect sets a global flag brokerConnected
     startConnect = time.time()
+    connectEvent.clear()
     mqttc.loop_start()	# runs in the background, reconnects if needed
     mqttc.connect(mqttBroker, keepalive=mqttKeepAlive)
 
+    # sleep until on_connect() is called, a refused connection (rc!=0)
+    # is retried by paho so keep waiting till the timeout
+    deadline=startConnect+mqttConnectTimeout
     while not brokerConnected:
-        if (time.time() - startConnect) > mqttConnectTimeout:
+        remaining=deadline-time.time()
+        if remaining<=0 or not connectEvent.wait(remaining):
             logging.error("connectToBroker(): broker on_connect time out (%ss)", mqttConnectTimeout)
             print("connectToBroker: failed to connect to MQTT broker within timeout.")
             return False
+        connectEvent.clear()
 
     logging.info("connectToBroker(): Connected to MQTT broker after %s s", int(time.time() - startConnect))
     return True
@@ -200,18 +215,15 @@ msgHandler=devProcessor.msgHandler(mydb)
 message_number=0    # initial value after restart
 try:
     while True:
-        # anything to do?
-        if not job_queue.empty():
-            # make sure the dabase is alive and well
-            mydb.ping(reconnect=True, attempts=5, delay=1)
-            # TODO add code to check if the connection is really up
-            # retrieve the next job and process it
-            processJob(message_number,job_queue.get())
-            # bump the message number with wrap around
-            message_number=(message_number+1) % MAX_MESSAGE_NUMBER
-        else:
-            # wait nicely
-            time.sleep(0.1)
+        # wait for something to do
+        jsonString=job_queue.get()
+        # make sure the dabase is alive and well
+        mydb.ping(reconnect=True, attempts=5, delay=1)
+        # TODO add code to check if the connection is really up
+        # process the job
+        processJob(message_number,jsonString)
+        # bump the message number with wrap around
+        message_number=(message_number+1) % MAX_MESSAGE_NUMBER
 except Exception as e:
     logging.exception("program terminated",e)
 
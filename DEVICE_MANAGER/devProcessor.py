@@ -74,11 +74,12 @@ NOTE: underscored methods below are not meant to be called externally (except by
 
 """
 
-import json
 import mysql.connector
 import time
 import logging
 import sys
+import dbHelper     # from the Shared folder
+import jsonCodec    # from the Shared folder
 
 
 # aliases for device table fields in JSON
@@ -187,8 +188,8 @@ class msgHandler:
         thisDev=None
 
         try:
-            # payload string was UTF-8 decoded when added to the job queue
-            self._payloadDict = json.loads(payload)
+            # payload is the MQTT payload bytes, jsonCodec decodes them directly
+            self._payloadDict = jsonCodec.loads(payload)
             logging.info("%s decodeJSON(): JSON was read ok", msg_num)
 
             # a device name and command are compulsory
@@ -245,7 +246,7 @@ class msgHandler:
             STATUS: status,
             MSG: msg
         }
-        r=json.dumps(reply)
+        r=jsonCodec.dumps(reply)
         logging.info("%s Reply = %s ",msg_num,r)
         return r
 
@@ -454,18 +455,11 @@ class msgHandler:
 
         sql = sql + fieldList + ") values (" +valueList + ");"
         try:
-            # add the new type record
-            mycursor=self._mydb.cursor()
-            mycursor.execute(sql, self._typeInfo)
-            self._mydb.commit()
-
-            # get the new type ID
-            mycursor.execute("select max(device_type) from device_types;")
-            r=mycursor.fetchone()
-            if r is None:
-                logging.error("%s _addDeviceType() max(device_type) returned None.", msg_num)
+            # add the new type record, returns the new type ID
+            typeId=dbHelper.insertRow(self._mydb, sql, self._typeInfo)
+            if not typeId:
+                logging.error("%s _addDeviceType() insert did not return a device_type.", msg_num)
                 return None # failed to insert??
-            typeId=r[0]
             logging.info("%s _addDeviceType() new type id=%s",msg_num,typeId)
             return typeId
 
@@ -505,19 +499,12 @@ class msgHandler:
 
         sql = sql + fieldList + ") values (" +valueList + "); "
         try:
-            # add the owner record
-            mycursor=self._mydb.cursor()
-            mycursor.execute(sql, self._ownerInfo)
-            self._mydb.commit()
-
-            # get the owner_id
-            mycursor.execute("select max(owner_id) from owners;")
-            r=mycursor.fetchone()
+            # add the owner record, returns the owner_id
+            owner_id=dbHelper.insertRow(self._mydb, sql, self._ownerInfo)
 
-            if r is None:
-                logging.error("%s _addOwner() returns None for max(owner_id)",msg_num)
+            if not owner_id:
+                logging.error("%s _addOwner() insert did not return an owner_id",msg_num)
                 return None
-            owner_id=r[0]
             logging.info("%s _addOwner() returns owner_id=%s",msg_num,owner_id)
             return owner_id
 
@@ -596,20 +583,12 @@ class msgHandler:
 
             sql = sql + fieldList + ") values (" + valueList + ");" # "
 
-            # insert the record
-            mycursor=self._mydb.cursor()
-            mycursor.execute(sql,self._devInfo)
-            self._mydb.commit()
-
-            # get back the new device id
-            mycursor.execute("select max(device_id) from devices;")
-            r=mycursor.fetchone()
-            if r is None:
+            # insert the record, returns the new device id
+            device_id=dbHelper.insertRow(self._mydb, sql, self._devInfo)
+            if not device_id:
                 logging.error("%s _addNewDevice() failed to return device_id",msg_num)
                 return (FAILED,"Unable to add a new device")
 
-            logging.info("%s _addNewDevice max device_id returns %s",r)
-            device_id=r[0]
             logging.info("%s _addNewDevice() Returns device_id %s", msg_num,device_id)
             # finally add sensors to the device_sensors table
             (r,msg)=self._addSensors(msg_num,device_id)
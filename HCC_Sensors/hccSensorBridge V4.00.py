@@ -16,18 +16,20 @@ in the main loop.
 
 # note: do not import ttn before logging!! it appears to kill the logger
 import time
-import json
 import paho.mqtt.client as paho
 import sys
 import os
 import logging
 import toml
 import queue
+import threading
 from socket import error as SktErr
+import logHelper    # from the Shared folder
+import jsonCodec    # from the Shared folder
 
 
 
-VERSION="3.0"   # for the log file
+VERSION="4.01"   # for the log file
 print("running on python ",sys.version[0])
 
 # get config values and check they exist
@@ -39,6 +41,8 @@ ttnClient= paho.Client()
 chClient = paho.Client()
 ttnConnected=False
 chConnected=False
+ttnConnectEvent=threading.Event()   # set by ttn_on_connect()
+chConnectEvent=threading.Event()    # set by ch_on_connect()
 
 try:
     config = toml.load(configFile)
@@ -54,7 +58,7 @@ try:
         pidFile = config["settings"]["pidFile"]
 
     # logging
-    logging.basicConfig(filename=logFile, format='%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', level=logging.DEBUG)
+    logHelper.setup(logFile, '%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', shared.get("logging"))
     logging.info("############################### ")
     logging.info("Starting hccSensorBridge data collector Vsn: %s",VERSION)
 
@@ -138,6 +142,7 @@ def ch_on_connect(client, userdata, flags,rc):
     if rc==0:
         logging.info("connected to CH server ok")
         chConnected=True
+        chConnectEvent.set()
     else:
         logging.info(f"ch_on_connect(): {mqttRc[rc]}")
 
@@ -159,11 +164,11 @@ def ch_on_publish(client,userdata,rc):
 def ttn_on_message(client, obj,msg):
     global job_queue
 
-    logging.info(f"recieved msg {msg.payload}")
+    logging.info("recieved msg %s",msg.payload)
     
-    JSON=json.loads(msg.payload)
+    JSON=jsonCodec.loads(msg.payload)
 
-    logging.debug(f"parsedJSON={JSON}")
+    logging.debug("parsedJSON=%s",JSON)
     
     chPayload = {}
     
@@ -187,8 +192,8 @@ def ttn_on_message(client, obj,msg):
         chPayload["gtw_id"] = gw_metadata["gateway_ids"]["gateway_id"]
         chPayload["timestamp"] = JSON["uplink_message"]["received_at"]
         
-        jsonPayload = json.dumps(chPayload)
-        logging.info(f"on_message payload {chPayload}")
+        jsonPayload = jsonCodec.dumps(chPayload)
+        logging.info("on_message payload %s",chPayload)
         job_queue.put(jsonPayload)
     
     except Exception as e:
@@ -211,6 +216,7 @@ def ttn_on_connect(client,userdata,flags,rc):
         logging.info("connected to TTN server ok")
         ttnClient.subscribe("#",0)
         ttnConnected=True
+        ttnConnectEvent.set()
     else:
         logging.info(f"ttn_on_connect():  {mqttRc[rc]}")
 
@@ -304,30 +310,25 @@ if connectToCH() and connectToTTN():
     if not ttnConnected or not chConnected:
         logging.info(f"Waiting for mqtt connect. ttn {ttnConnected} ch {chConnected}")
 
-    start=time.time()
-    while not ttnConnected or not chConnected:
-        if (time.time()-start)>60:
-            logging.error(f"on_connect failed after 60s ttnConnected:{ttnConnected} chConnected:{chConnected}")
-            exit("connect failed")
+    # sleep till both on_connect callbacks have been received
+    deadline=time.time()+60
+    if not chConnectEvent.wait(max(deadline-time.time(),0)) or not ttnConnectEvent.wait(max(deadline-time.time(),0)):
+        logging.error(f"on_connect failed after 60s ttnConnected:{ttnConnected} chConnected:{chConnected}")
+        exit("connect failed")
 
     logging.info("Waiting for ttn message callbacks")
 
     while True:
-        # anything to do?
+        # wait for something to do
         try:
-            if not job_queue.empty():
-                jsonPayload = job_queue.get()  # retrieve the next job
-                process_job(jsonPayload)
+            jsonPayload = job_queue.get()  # retrieve the next job
+            process_job(jsonPayload)
         except SktErr as e:
             logging.error(f"Socket error {e}")
             chClient.disconnect()
             ttnClient.disconnect()
             exit("Socket error")
 
-        # wait nicely
-        # allow system processes to run
-        time.sleep(0.1)
-
 
 
 
@@ -0,0 +1,582 @@
+#!/usr/bin/python3
+"""
+benchIngest.py
+
+Authors: Brian Norman
+Date: 18/10/2026
+Version: 1.0
+Python Ver: 3
+
+Ingest benchmark for dbLoader. Everything runs on this machine in a temporary folder which is
+deleted afterwards:-
+
+	broker   - mosquitto on a free port if it is installed, otherwise miniBroker.py (in this process)
+	           or the broker in benchIngest.toml [broker]
+	database - a throwaway MariaDB server (mariadb-install-db + mariadbd) or a throwaway database
+	           on the server in [database]. Built from database/aqdb_V4_nodata.sql with the
+	           bench-0001... devices and the usual reading_value_types
+	dbLoader - Subscriber/dbLoader V3.00.py with a copy of its dbLoader.toml, [dbLoader] in
+	           benchIngest.toml is merged into it
+
+Messages are published at [bench] rate for duration_secs, made up (synthetic) or replayed from an
+NDJSON file of recorded payloads. Each message's "dev" and "timestamp" are rewritten so every
+message is a new reading for one of the bench devices. The readings table is polled to see when
+each message was committed.
+
+The results are printed as one line of JSON (or appended to the --out file) so runs can be
+compared to spot regressions:-
+
+	sustained_msgs_per_sec - readings committed per second, first publish to last commit
+	latency_ms             - publish to commit, p50/p90/p99/max (to within poll_ms)
+	db                     - round trips and statements per message from the server's status
+	                         counters (only meaningful if nothing else is using the server)
+	stages_ms              - dbLoader's mean time per stage from its /metrics
+
+usage:
+	python3 benchIngest.py [--config benchIngest.toml] [--rate 500] [--duration 60] [--devices 50]
+	                       [--payloads payloads.ndjson] [--out results.ndjson] [--label text] [--keep]
+
+"""
+
+import sys
+import os
+import re
+import argparse
+import json
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import getpass
+import urllib.request
+from datetime import datetime,timedelta,timezone
+import toml
+import mysql.connector
+import paho.mqtt.client as paho
+import miniBroker
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DBLOADER=os.path.join(REPO,"Subscriber","dbLoader V3.00.py")
+DBLOADER_TOML=os.path.join(REPO,"Subscriber","dbLoader.toml")
+SHARED_TOML=os.path.join(REPO,"Shared","Shared.toml")
+SCHEMA=os.path.join(REPO,"database","aqdb_V4_nodata.sql")
+
+# short_descr,friendly_text for reading_value_types
+READING_TYPES=[("temperature","Temperature C"),("humidity","Relative humidity %"),("pressure","Pressure mbar"),
+	("PM10","PM10 ug/m3"),("PM25","PM2.5 ug/m3"),("PM1","PM1 ug/m3"),("NO","NO ug/m3"),("NO2","NO2 ug/m3"),
+	("NOXasNO2","NOx as NO2 ug/m3"),("SO2","SO2 ug/m3"),("O3","O3 ug/m3"),("pax_bluetooth","Bluetooth devices")]
+
+# server status counters reported per message
+DB_COUNTERS=("Questions","Com_admin_commands","Com_stmt_prepare","Com_stmt_execute","Com_commit","Com_insert","Com_update","Com_select")
+
+#####################################
+#
+# log(text)
+#
+# progress goes to stderr, stdout is kept for the results
+#
+def log(text,*args):
+	print(time.strftime("%H:%M:%S"),text % args,file=sys.stderr,flush=True)
+
+def freePort():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1",0))
+		return s.getsockname()[1]
+
+#####################################
+#
+# mergeSettings(config,overrides)
+#
+# copies overrides into config, tables are merged key by key
+# (the same as dbLoader's)
+#
+def mergeSettings(config,overrides):
+	for key,value in overrides.items():
+		if isinstance(value,dict) and isinstance(config.get(key),dict):
+			mergeSettings(config[key],value)
+		else:
+			config[key]=value
+
+#####################################
+#
+# percentile(values,q)
+#
+# values must be sorted
+#
+def percentile(values,q):
+	if len(values)==0:
+		return None
+	return values[min(len(values)-1,int(q*len(values)))]
+
+#####################################
+#
+# startBroker(folder,settings)
+#
+# returns (host,port,name,stop function)
+#
+def startBroker(folder,settings):
+	if settings["host"]!="":
+		return settings["host"],settings["port"],"external",lambda: None
+
+	port=freePort()
+	mosquitto=shutil.which("mosquitto")
+	if mosquitto is not None:
+		conf=os.path.join(folder,"mosquitto.conf")
+		with open(conf,"w") as f:
+			f.write("listener %d 127.0.0.1\nallow_anonymous true\nmax_inflight_messages 1000\nmax_queued_messages 100000\n" % port)
+		process=subprocess.Popen([mosquitto,"-c",conf],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+		waitForPort(port,process,"mosquitto")
+		return "127.0.0.1",port,"mosquitto",lambda: stopProcess(process)
+
+	broker=miniBroker.Broker("127.0.0.1",port)
+	broker.start()
+	return "127.0.0.1",port,"miniBroker",broker.stop
+
+def waitForPort(port,process,name,timeout=30):
+	deadline=time.time()+timeout
+	while time.time()<deadline:
+		if process.poll() is not None:
+			raise RuntimeError(f"{name} exited with code {process.returncode}")
+		try:
+			socket.create_connection(("127.0.0.1",port),timeout=1).close()
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError(f"{name} did not start listening on port {port}")
+
+def stopProcess(process):
+	if process.poll() is None:
+		process.terminate()
+		try:
+			process.wait(30)
+		except subprocess.TimeoutExpired:
+			process.kill()
+
+#####################################
+#
+# startDatabase(folder,settings)
+#
+# returns (connection settings for mysql.connector,server description,stop function)
+# the connection settings include the throwaway database
+#
+def startDatabase(folder,settings):
+	dbname="aqbench_%d" % os.getpid()
+
+	if settings["host"]!="":
+		connection={"host":settings["host"],"port":settings["port"],"user":settings["user"],"passwd":settings["passwd"]}
+		stop=lambda: dropDatabase(connection,dbname)
+	else:
+		install=shutil.which("mariadb-install-db") or shutil.which("mysql_install_db")
+		server=shutil.which("mariadbd") or shutil.which("mysqld")
+		if install is None or server is None:
+			raise RuntimeError("MariaDB is not installed, set [database] host in benchIngest.toml to use a server")
+
+		datadir=os.path.join(folder,"mariadb")
+		user="--user="+getpass.getuser()
+		log("creating a MariaDB data folder in %s",datadir)
+		subprocess.run([install,"--no-defaults","--datadir="+datadir,user],check=True,stdout=subprocess.DEVNULL,stderr=subprocess.STDOUT)
+
+		port=freePort()
+		process=subprocess.Popen([server,"--no-defaults","--datadir="+datadir,user,
+			"--socket="+os.path.join(folder,"mariadb.sock"),"--port=%d" % port,"--bind-address=127.0.0.1",
+			"--pid-file="+os.path.join(folder,"mariadb.pid"),"--log-error="+os.path.join(folder,"mariadb.err"),
+			"--skip-grant-tables"]+settings["server_args"],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+		waitForPort(port,process,"mariadbd",timeout=60)
+		connection={"host":"127.0.0.1","port":port,"user":"root","passwd":""}
+		stop=lambda: stopProcess(process)
+
+	try:
+		mydb=mysql.connector.connect(**connection)
+		mycursor=mydb.cursor()
+		mycursor.execute("SELECT VERSION()")
+		version=mycursor.fetchone()[0]
+		mycursor.execute(f"CREATE DATABASE {dbname}")
+		mydb.close()
+	except Exception:
+		stop()
+		raise
+
+	connection["database"]=dbname
+	return connection,version,stop
+
+def dropDatabase(connection,dbname):
+	mydb=mysql.connector.connect(**connection)
+	mydb.cursor().execute(f"DROP DATABASE IF EXISTS {dbname}")
+	mydb.close()
+
+#####################################
+#
+# splitSql(text)
+#
+# splits a mysqldump file into statements, understands DELIMITER
+#
+def splitSql(text):
+	statements=[]
+	delimiter=";"
+	current=[]
+	for line in text.splitlines():
+		stripped=line.strip()
+		if len(current)==0 and (stripped=="" or stripped.startswith("--")):
+			continue
+		if stripped.upper().startswith("DELIMITER "):
+			delimiter=stripped.split()[1]
+			continue
+		current.append(line)
+		if stripped.endswith(delimiter):
+			statement="\n".join(current).rstrip()[:-len(delimiter)].strip()
+			if statement!="":
+				statements.append(statement)
+			current=[]
+	return statements
+
+#####################################
+#
+# loadDatabase(connection,devices)
+#
+# creates the tables, reading_value_types and devices
+#
+# returns a dictionary device name:device_id
+#
+def loadDatabase(connection,devices):
+	mydb=mysql.connector.connect(**connection)
+	mycursor=mydb.cursor()
+	with open(SCHEMA) as f:
+		for statement in splitSql(f.read()):
+			try:
+				mycursor.execute(statement)
+			except mysql.connector.Error as e:
+				# the ST_DISTANCE_SPHERE function is only used by the API
+				if not statement.startswith("CREATE DEFINER"):
+					raise
+				log("schema: %s skipped, %s",statement.split("(")[0],e)
+
+	mycursor.executemany("INSERT INTO reading_value_types (short_descr,friendly_text) VALUES (%s,%s)",READING_TYPES)
+	mycursor.execute("INSERT INTO device_class (id,description) VALUES (1,'benchmark')")
+	mycursor.execute("INSERT INTO device_types (device_type,Other) VALUES (1,'benchmark')")
+	names=["bench-%04d" % (n+1) for n in range(devices)]
+	mycursor.executemany("INSERT INTO devices (device_name,device_type,class) VALUES (%s,1,1)",[(name,) for name in names])
+	mydb.commit()
+
+	mycursor.execute("SELECT device_name,device_id FROM devices")
+	deviceIds=dict(mycursor.fetchall())
+	mydb.close()
+	return deviceIds
+
+#####################################
+#
+# startDbLoader(folder,config,broker,connection)
+#
+# writes dbLoader.toml and Shared.toml into folder and starts dbLoader
+#
+# returns (process,metrics port)
+#
+def startDbLoader(folder,config,broker,connection):
+	shared=toml.load(SHARED_TOML)
+	shared["mqtt"].update({"host":broker[0],"port":broker[1],"topic":config["bench"]["topic"],"user":"","passwd":""})
+	shared["database"].update({"host":connection["host"],"port":connection["port"],"user":connection["user"],
+		"passwd":connection["passwd"],"dbname":connection["database"]})
+	with open(os.path.join(folder,"Shared.toml"),"w") as f:
+		toml.dump(shared,f)
+
+	metricsPort=freePort()
+	settings=toml.load(DBLOADER_TOML)
+	mergeSettings(settings,config["dbLoader"])
+	for target in (settings["settings"],settings["debug"]["settings"]):
+		target["logfile"]=os.path.join(folder,"dbLoader.log")
+		target["pidfile"]=os.path.join(folder,"dbLoader.pid")
+	settings["spool"]["directory"]=os.path.join(folder,"spool")
+	settings["overflow"]["spill_file"]=os.path.join(folder,"dbLoader.spill")
+	settings["metrics"].update({"enabled":True,"host":"127.0.0.1","port":metricsPort})
+	settings["cluster"]["enabled"]=False
+	with open(os.path.join(folder,"dbLoader.toml"),"w") as f:
+		toml.dump(settings,f)
+
+	env=dict(os.environ)
+	env["PYTHONPATH"]=os.pathsep.join([os.path.join(REPO,"Shared")]+([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+	with open(os.path.join(folder,"dbLoader.out"),"w") as out:
+		process=subprocess.Popen([sys.executable,DBLOADER],cwd=folder,env=env,stdout=out,stderr=subprocess.STDOUT)
+
+	# ready once it has subscribed
+	logFile=os.path.join(folder,"dbLoader.log")
+	deadline=time.time()+60
+	while time.time()<deadline:
+		if process.poll() is not None:
+			raise RuntimeError("dbLoader exited, see "+os.path.join(folder,"dbLoader.out")+" and dbLoader.log")
+		if os.path.exists(logFile):
+			with open(logFile) as f:
+				if "on_subscribe()" in f.read():
+					return process,metricsPort
+		time.sleep(0.2)
+	stopProcess(process)
+	raise RuntimeError("dbLoader did not subscribe within 60s, see "+logFile)
+
+#####################################
+#
+# payloads(config,deviceNames)
+#
+# yields (device name,recordedon,payload bytes) for ever
+#
+# recordedon is the reading's timestamp as the database returns it. Each
+# device's readings are one second apart starting 30 days ago so they
+# are all different (the unique key on readings would skip repeats)
+#
+def payloads(config,deviceNames):
+	generator=random.Random(1)		# the same messages every run
+	templates=None
+	if config["bench"]["payloads"]!="":
+		with open(config["bench"]["payloads"]) as f:
+			templates=[json.loads(line) for line in f if line.strip()!=""]
+
+	start=(datetime.now(timezone.utc)-timedelta(days=30)).replace(microsecond=0)
+	sent={name:0 for name in deviceNames}
+	n=0
+	while True:
+		name=deviceNames[n%len(deviceNames)]
+		recordedOn=start+timedelta(seconds=sent[name])
+		sent[name]+=1
+		if templates is not None:
+			payload=dict(templates[n%len(templates)])
+		else:
+			payload={"temp":round(generator.uniform(-5,30),1),"humidity":round(generator.uniform(30,100),1),
+				"pressure":generator.randint(960,1040),"PM10":round(generator.uniform(0,60),1),
+				"PM25":round(generator.uniform(0,40),1)}
+		payload["dev"]=name
+		payload["timestamp"]=recordedOn.strftime("%Y-%m-%dT%H:%M:%SZ")
+		yield name,recordedOn.strftime("%Y-%m-%d %H:%M:%S"),json.dumps(payload).encode("UTF-8")
+		n+=1
+
+#####################################
+#
+# Poller
+#
+# thread which polls readings for new rows and works out how long after
+# publishing each one was committed. Rows are committed by more than one
+# worker so ids don't become visible in order, the last WINDOW ids are
+# looked at again each time
+#
+class Poller(threading.Thread):
+	WINDOW=2000
+
+	def __init__(self,connection,sendTimes,pollMs):
+		super().__init__(name="poller",daemon=True)
+		self.mydb=mysql.connector.connect(**connection)
+		self.mydb.autocommit=True		# see every commit, not a snapshot
+		self.sendTimes=sendTimes		# (device_id,recordedon):publish time, shared with the publisher
+		self.pollSecs=pollMs/1000
+		self.latencies=[]
+		self.lastCommit=None
+		self.lastId=0
+		self.queries=0					# subtracted from the server's counters
+		self.stopping=threading.Event()
+
+	def run(self):
+		mycursor=self.mydb.cursor()
+		while not self.stopping.is_set():
+			start=time.time()
+			mycursor.execute("SELECT id,device_id,recordedon FROM readings WHERE id>%s",(max(0,self.lastId-self.WINDOW),))
+			rows=mycursor.fetchall()
+			self.queries+=1
+			now=time.time()
+			for readingId,deviceId,recordedOn in rows:
+				sent=self.sendTimes.pop((deviceId,str(recordedOn)),None)
+				if sent is not None:
+					self.latencies.append(now-sent)
+					self.lastCommit=now
+				self.lastId=max(self.lastId,readingId)
+			self.stopping.wait(max(0,self.pollSecs-(time.time()-start)))
+
+	def stop(self):
+		self.stopping.set()
+		self.join()
+		self.mydb.close()
+
+#####################################
+#
+# serverCounters(mydb)
+#
+# returns the DB_COUNTERS from SHOW GLOBAL STATUS, the SHOW itself is
+# counted in Questions
+#
+def serverCounters(mydb):
+	mycursor=mydb.cursor()
+	mycursor.execute("SHOW GLOBAL STATUS")
+	return {name:int(value) for name,value in mycursor.fetchall() if name in DB_COUNTERS}
+
+#####################################
+#
+# stageTimes(metricsPort)
+#
+# reads dbLoader's /metrics and returns stage:mean milliseconds
+#
+def stageTimes(metricsPort):
+	text=urllib.request.urlopen(f"http://127.0.0.1:{metricsPort}/metrics",timeout=10).read().decode("UTF-8")
+	sums={}
+	counts={}
+	for name,stage,value in re.findall(r'^dbloader_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$',text,re.M):
+		(sums if name=="sum" else counts)[stage]=float(value)
+	return {stage:round(1000*sums[stage]/counts[stage],4) for stage in counts if counts[stage]>0}
+
+#####################################
+#
+# publish(config,broker,deviceIds,sendTimes)
+#
+# publishes at rate messages/s for duration_secs
+#
+# returns (messages published,first publish time,last publish time)
+#
+def publish(config,broker,deviceIds,sendTimes):
+	bench=config["bench"]
+	if hasattr(paho,"CallbackAPIVersion"):
+		client=paho.Client(paho.CallbackAPIVersion.VERSION1)
+	else:
+		client=paho.Client()
+	connected=threading.Event()
+	client.on_connect=lambda client,userdata,flags,rc: connected.set()
+	client.max_inflight_messages_set(1000)
+	client.connect(broker[0],broker[1])
+	client.loop_start()
+	if not connected.wait(30):
+		raise RuntimeError("unable to connect to the broker")
+
+	rate=bench["rate"]
+	messages=payloads(config,sorted(deviceIds.keys()))
+	start=time.time()
+	end=start+bench["duration_secs"]
+	n=0
+	info=None
+	while True:
+		now=time.time()
+		if now>=end:
+			break
+		if rate>0:
+			due=start+n/rate
+			if due>now:
+				time.sleep(due-now)
+		name,recordedOn,payload=next(messages)
+		sendTimes[(deviceIds[name],recordedOn)]=time.time()
+		info=client.publish(bench["topic"],payload,qos=bench["qos"])
+		n+=1
+	last=time.time()
+
+	if info is not None and bench["qos"]>0:
+		info.wait_for_publish(60)
+	client.disconnect()
+	client.loop_stop()
+	return n,start,last
+
+
+if __name__=="__main__":
+	parser=argparse.ArgumentParser(description="dbLoader ingest benchmark")
+	parser.add_argument("--config",default=os.path.join(os.path.dirname(os.path.abspath(__file__)),"benchIngest.toml"))
+	parser.add_argument("--rate",type=float,help="messages per second, 0=as fast as possible")
+	parser.add_argument("--duration",type=float,help="seconds to publish for")
+	parser.add_argument("--devices",type=int,help="number of devices")
+	parser.add_argument("--payloads",help="NDJSON file of recorded payloads")
+	parser.add_argument("--out",help="append the results to this file instead of printing them")
+	parser.add_argument("--label",default="",help="saved with the results e.g. the change being measured")
+	parser.add_argument("--keep",action="store_true",help="keep the temporary folder (logs, configs)")
+	args=parser.parse_args()
+
+	config=toml.load(args.config)
+	bench=config["bench"]
+	for key,value in (("rate",args.rate),("duration_secs",args.duration),("devices",args.devices),("payloads",args.payloads)):
+		if value is not None:
+			bench[key]=value
+
+	folder=tempfile.mkdtemp(prefix="benchIngest-")
+	stops=[]
+	try:
+		broker=startBroker(folder,config["broker"])
+		stops.append(broker[3])
+		log("broker %s on %s:%s",broker[2],broker[0],broker[1])
+
+		connection,dbVersion,stop=startDatabase(folder,config["database"])
+		stops.append(stop)
+		deviceIds=loadDatabase(connection,bench["devices"])
+		log("database %s on %s:%s, %s devices",connection["database"],connection["host"],connection["port"],len(deviceIds))
+
+		dbLoader,metricsPort=startDbLoader(folder,config,broker,connection)
+		stops.append(lambda: stopProcess(dbLoader))
+		with open(DBLOADER) as f:
+			dbLoaderVersion=re.search(r'^VERSION="([^"]+)"',f.read(),re.M).group(1)
+		log("dbLoader %s running",dbLoaderVersion)
+
+		sendTimes={}
+		poller=Poller(connection,sendTimes,bench["poll_ms"])
+		statusDb=mysql.connector.connect(**connection)
+		before=serverCounters(statusDb)
+		poller.start()
+
+		log("publishing at %s msgs/s for %ss",bench["rate"] or "max",bench["duration_secs"])
+		published,firstSent,lastSent=publish(config,broker,deviceIds,sendTimes)
+		log("published %s messages in %.1fs, waiting for dbLoader",published,lastSent-firstSent)
+
+		# wait till everything is in or nothing new has arrived for drain_secs
+		lastProgress=time.time()
+		committed=0
+		while len(sendTimes)>0 and time.time()-lastProgress<bench["drain_secs"]:
+			time.sleep(0.5)
+			if len(poller.latencies)>committed:
+				committed=len(poller.latencies)
+				lastProgress=time.time()
+		poller.stop()
+		after=serverCounters(statusDb)
+		statusDb.close()
+		stages=stageTimes(metricsPort)
+
+		latencies=sorted(poller.latencies)
+		committed=len(latencies)
+		# the poller's queries and the second SHOW GLOBAL STATUS are not dbLoader's
+		delta={name:after.get(name,0)-before.get(name,0) for name in DB_COUNTERS}
+		delta["Questions"]-=poller.queries+1
+		delta["Com_select"]-=poller.queries
+		roundTrips=delta["Questions"]+delta["Com_admin_commands"]+delta["Com_stmt_prepare"]
+
+		results={
+			"benchmark":"benchIngest",
+			"label":args.label,
+			"date":datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+			"host":socket.gethostname(),
+			"dbLoader_version":dbLoaderVersion,
+			"broker":broker[2],
+			"database":dbVersion,
+			"config":{"rate":bench["rate"],"duration_secs":bench["duration_secs"],"devices":bench["devices"],
+				"payloads":os.path.basename(bench["payloads"]) if bench["payloads"]!="" else "synthetic",
+				"qos":bench["qos"],"poll_ms":bench["poll_ms"],"dbLoader":config["dbLoader"]},
+			"published":published,
+			"committed":committed,
+			"missing":published-committed,
+			"publish_msgs_per_sec":round(published/max(lastSent-firstSent,0.001),1),
+			"sustained_msgs_per_sec":round(committed/(poller.lastCommit-firstSent),1) if committed>0 else 0,
+			"latency_ms":{q:round(1000*percentile(latencies,v),1) if committed>0 else None
+				for q,v in (("p50",0.5),("p90",0.9),("p99",0.99),("max",1.0))},
+			"db":{"round_trips_per_msg":round(roundTrips/max(committed,1),3),
+				"statements_per_msg":round(delta["Questions"]/max(committed,1),3),
+				"commits_per_msg":round(delta["Com_commit"]/max(committed,1),3),
+				"counters":delta},
+			"stages_ms":stages,
+		}
+
+		if args.out:
+			with open(args.out,"a") as f:
+				f.write(json.dumps(results)+"\n")
+			log("results appended to %s",args.out)
+		else:
+			print(json.dumps(results))
+		log("%s/%s committed, %s msgs/s sustained, latency p50 %sms p99 %sms, %s round trips per message",
+			committed,published,results["sustained_msgs_per_sec"],results["latency_ms"]["p50"],
+			results["latency_ms"]["p99"],results["db"]["round_trips_per_msg"])
+
+	finally:
+		for stop in reversed(stops):
+			try:
+				stop()
+			except Exception as e:
+				log("cleanup: %s",e)
+		if args.keep:
+			log("logs and configs kept in %s",folder)
+		else:
+			shutil.rmtree(folder,ignore_errors=True)
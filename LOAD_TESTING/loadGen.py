@@ -0,0 +1,444 @@
+#!/usr/bin/python3
+"""
+loadGen.py
+
+Authors: Brian Norman
+Date: 18/10/2026
+Version: 1.0
+Python Ver: 3
+
+Synthetic load generator for sizing the broker, dbLoader and the database. It publishes what the
+bridges publish, for as many made up devices as you like:-
+
+	hcc     - hccSensorBridge's messages from TTN uplinks, every few minutes from each device at
+	          its own time (temp, humidity, pressure, PM10, PM25, RSSI, gtw_id, TTN timestamp)
+	clarity - clarityBridge's hourly batch, every device at the top of the hour with the
+	          previous hour's averages and its latitude/longitude
+	defra   - defraBridge's backfill, every station at the top of the hour with the hours since
+	          it last ran in timestamp order. The first run goes back first_run_hours (never_seen)
+	pubtest - the edge cases in Subscriber/pubTest, extra keys, lat/long, odd timestamps
+
+Device counts, reporting intervals, alignment to the top of the hour and the share of malformed
+and unknown device messages are set in loadGen.toml. [loadgen] scale multiplies every source's
+device count so scale=10 or 100 gives ten or a hundred times today's devices.
+
+Time is simulated. speed=60 runs an hour in a minute (the messages carry the simulated
+timestamps) and --start sets the simulated clock e.g. a minute before the hour to see the
+hourly burst straight away.
+
+--register sends devManager an addNewDevice command for each device first, so dbLoader accepts
+their messages. The device class and sensors in loadGen.toml must exist in the database.
+
+usage:
+	python3 loadGen.py [--config loadGen.toml] [--scale 10] [--duration 600] [--speed 60]
+	                   [--start 2026-10-18T09:59:00] [--register] [--register-only] [--ndjson file|-]
+
+"""
+
+import sys
+import os
+import argparse
+import heapq
+import json
+import random
+import threading
+import time
+from datetime import datetime,timezone
+import toml
+import paho.mqtt.client as paho
+
+SOURCES=("hcc","clarity","defra","pubtest")
+
+# (low,high,decimal places) for made up readings
+VALUE_RANGES={
+	"temp":(-5,30,1),
+	"humidity":(20,100,1),
+	"pressure":(960,1040,0),
+	"PM10":(0,60,1),
+	"PM25":(0,40,1),
+	"NO":(0,60,1),
+	"NO2":(0,80,1),
+	"NOXasNO2":(0,120,1),
+	"SO2":(0,10,1),
+	"O3":(0,90,1),
+	"RSSI":(-120,-60,0),
+}
+
+ALREADY_EXISTS="device name already exists"		# devProcessor's reply
+
+#####################################
+#
+# log(text)
+#
+# progress goes to stderr, stdout may be the --ndjson output
+#
+def log(text,*args):
+	print(time.strftime("%H:%M:%S"),text % args,file=sys.stderr,flush=True)
+
+def reading(generator,key):
+	low,high,places=VALUE_RANGES[key]
+	value=generator.uniform(low,high)
+	return int(round(value)) if places==0 else round(value,places)
+
+def isoTime(seconds,fraction=""):
+	return datetime.fromtimestamp(int(seconds),tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")+fraction
+
+#####################################
+#
+# makeDevices(config,generator)
+#
+# returns a list of devices, dictionaries with the source, name and
+# location. [loadgen] scale multiplies each source's devices
+#
+def makeDevices(config,generator):
+	loadgen=config["loadgen"]
+	lat,lon=loadgen["centre"]
+	radius=loadgen["radius_deg"]
+	devices=[]
+	for source in SOURCES:
+		settings=config["sources"].get(source)
+		if settings is None:
+			continue
+		for n in range(int(settings["devices"]*loadgen["scale"])):
+			devices.append({
+				"source":source,
+				"name":settings["name"] % (n+1),
+				"lat":round(lat+generator.uniform(-radius,radius),6),
+				"lon":round(lon+generator.uniform(-radius,radius),6),
+				"runs":0,		# defra uses this for the first run's backfill
+				})
+	return devices
+
+#####################################
+#
+# nextDue(settings,after,generator,first=False)
+#
+# returns the simulated time a device next reports, after the time given.
+# Aligned sources report together at the start of each interval (the top
+# of the hour for 3600) plus up to jitter_secs, the others spread out
+#
+def nextDue(settings,after,generator,first=False):
+	interval=settings["interval_secs"]
+	if settings["align"]:
+		return (int(after//interval)+1)*interval+generator.uniform(0,settings["jitter_secs"])
+	if first:
+		return after+generator.uniform(0,interval)
+	return after+interval+generator.uniform(-settings["jitter_secs"],settings["jitter_secs"])
+
+#####################################
+#
+# source messages
+#
+# each returns a list of payload dictionaries for one report from device
+# at simulated time due
+#
+def hccMessages(settings,device,due,generator):
+	payload={"dev":device["name"]}
+	for key in ("temp","humidity","pressure","PM10","PM25","RSSI"):
+		payload[key]=reading(generator,key)
+	payload["gtw_id"]=generator.choice(settings["gateways"])
+	# TTN's received_at has nanoseconds
+	payload["timestamp"]=isoTime(due,".%09dZ" % int((due%1)*1e9))
+	return [payload]
+
+def clarityMessages(settings,device,due,generator):
+	# the bridge asks for the hour which ended an hour ago
+	hour=(int(due)//3600-1)*3600
+	payload={"dev":device["name"],"longitude":device["lon"],"latitude":device["lat"],"timestamp":isoTime(hour,".000Z")}
+	for key in ("PM25","PM10","temp","humidity","NO2"):
+		payload[key]=reading(generator,key)
+	return [payload]
+
+def defraMessages(settings,device,due,generator):
+	hours=settings["first_run_hours"] if device["runs"]==0 else settings["run_hours"]
+	device["runs"]+=1
+	last=int(due)//3600*3600
+	messages=[]
+	# oldest first, as defraBridge sends them
+	for hour in range(last-(hours-1)*3600,last+1,3600):
+		payload={key:reading(generator,key) for key in settings["readings"]}
+		payload["timestamp"]=datetime.fromtimestamp(hour,tz=timezone.utc).isoformat()
+		payload["dev"]=device["name"]
+		messages.append(payload)
+	return messages
+
+def pubtestMessages(settings,device,due,generator):
+	name=device["name"]
+	cases=[
+		{"TEMP":1,"dev":name,"temp":22,"pressure":1024,"humidity":80},			# extra keys are ignored
+		{"dev":name,"temp":22,"lat":device["lat"],"long":device["lon"]},			# location, long not lon
+		{"dev":name,"temp":22,"lat":device["lat"],"lon":device["lon"],"alt":5},
+		{"dev":name,"TEST":"timestamp decoding","timestamp":datetime.fromtimestamp(int(due),tz=timezone.utc).strftime("%a %b %d %Y %H:%M:%S GMT+0000"),"temp":25},
+		{"dev":name,"timestamp":"not a date","temp":24},
+		{"dev":name,"temp":"22.5","humidity":None},								# string and null values
+		{"dev":name},															# nothing to store
+	]
+	return [generator.choice(cases)]
+
+BUILDERS={"hcc":hccMessages,"clarity":clarityMessages,"defra":defraMessages,"pubtest":pubtestMessages}
+
+#####################################
+#
+# malformed(payload,generator)
+#
+# returns payload bytes dbLoader should reject, in the ways seen from
+# real publishers
+#
+def malformed(payload,generator):
+	text=json.dumps(payload)
+	return generator.choice([
+		text[1:],							# no leading brace
+		text[:-1],							# no trailing brace
+		text[:len(text)//2],				# truncated
+		json.dumps([payload]),				# not an object
+		json.dumps({k:v for k,v in payload.items() if k!="dev"}),	# no dev
+		]).encode("UTF-8")
+
+#####################################
+#
+# MqttSink / FileSink
+#
+# where the messages go, send(topic,payload bytes)
+#
+class MqttSink:
+
+	def __init__(self,broker):
+		if hasattr(paho,"CallbackAPIVersion"):
+			self.client=paho.Client(paho.CallbackAPIVersion.VERSION1)
+		else:
+			self.client=paho.Client()
+		if broker["user"]!="":
+			self.client.username_pw_set(username=broker["user"],password=broker["passwd"])
+		connected=threading.Event()
+		self.client.on_connect=lambda client,userdata,flags,rc: connected.set() if rc==0 else log("broker refused the connection rc=%s",rc)
+		self.client.max_inflight_messages_set(1000)
+		self.client.max_queued_messages_set(0)
+		self.client.connect(broker["host"],broker["port"])
+		self.client.loop_start()
+		if not connected.wait(30):
+			raise RuntimeError("unable to connect to the broker %s:%s" % (broker["host"],broker["port"]))
+		self.qos=broker["qos"]
+		self.info=None
+
+	def send(self,topic,payload):
+		self.info=self.client.publish(topic,payload,qos=self.qos)
+
+	def close(self):
+		if self.info is not None:
+			self.info.wait_for_publish(60)
+		self.client.disconnect()
+		self.client.loop_stop()
+
+class FileSink:
+
+	def __init__(self,path):
+		self.file=sys.stdout.buffer if path=="-" else open(path,"wb")
+
+	def send(self,topic,payload):
+		self.file.write(payload+b"\n")
+
+	def close(self):
+		self.file.flush()
+		if self.file is not sys.stdout.buffer:
+			self.file.close()
+
+#####################################
+#
+# registerDevices(config,devices)
+#
+# sends devManager an addNewDevice command for each device and waits
+# for the replies, in_flight at a time. Devices which already exist
+# count as registered
+#
+# returns (added,existed,failed)
+#
+def registerDevices(config,devices):
+	manager=config["devManager"]
+	broker=config["broker"]
+	sink=MqttSink(broker)
+	client=sink.client
+	pending={}
+	replies={}
+	done=threading.Condition()
+
+	def on_message(client,userdata,msg):
+		try:
+			reply=json.loads(msg.payload)
+		except ValueError:
+			return
+		with done:
+			if reply.get("dev") in pending:
+				del pending[reply["dev"]]
+				replies[reply["dev"]]=reply
+				done.notify_all()
+
+	client.on_message=on_message
+	client.subscribe(manager["reply_topic"],1)
+	time.sleep(0.5)		# let the subscription settle before the first reply
+
+	for device in devices:
+		settings=config["sources"][device["source"]]
+		command={"cmd":"addNewDevice","name":device["name"],"lat":device["lat"],"lon":device["lon"],
+			"class":settings["class"],"type":settings["type"],"sensors":settings["sensors"]}
+		with done:
+			if not done.wait_for(lambda: len(pending)<manager["in_flight"],manager["timeout_secs"]):
+				log("devManager: no reply in %ss for %s",manager["timeout_secs"],", ".join(pending))
+				pending.clear()
+			pending[device["name"]]=time.time()
+		client.publish(manager["install_topic"],json.dumps(command),qos=1)
+
+	with done:
+		done.wait_for(lambda: len(pending)==0,manager["timeout_secs"])
+		timedOut=list(pending)
+	sink.close()
+	if len(timedOut)>0:
+		log("devManager: no reply for %s",", ".join(timedOut[:10])+(" ..." if len(timedOut)>10 else ""))
+
+	added=existed=0
+	failed=list(timedOut)
+	for name,reply in replies.items():
+		if reply.get("status") is True:
+			added+=1
+		elif reply.get("msg")==ALREADY_EXISTS:
+			existed+=1
+		else:
+			failed.append(name)
+			if len(failed)<=10:
+				log("devManager: %s not registered, %s",name,reply.get("msg"))
+	return added,existed,failed
+
+#####################################
+#
+# Stats
+#
+# message counts per source, logged every stats_secs
+#
+class Stats:
+
+	def __init__(self):
+		self.counts={}		# (source,kind):count, kind is sent, malformed or unknown (also sent or malformed)
+		self.lastCount=0
+		self.lastTime=time.time()
+
+	def add(self,source,kind):
+		self.counts[(source,kind)]=self.counts.get((source,kind),0)+1
+
+	def total(self):
+		return sum(count for (source,kind),count in self.counts.items() if kind!="unknown")
+
+	def log(self,simNow):
+		now=time.time()
+		total=self.total()
+		rate=(total-self.lastCount)/max(now-self.lastTime,0.001)
+		self.lastCount,self.lastTime=total,now
+		bySource=", ".join("%s %s" % (source,sum(c for (s,k),c in self.counts.items() if s==source and k!="unknown"))
+			for source in SOURCES if any(s==source for s,k in self.counts))
+		log("%s: %s messages (%s), %s malformed, %s unknown device, %.0f msgs/s",isoTime(simNow),total,bySource or "none",
+			sum(c for (s,k),c in self.counts.items() if k=="malformed"),
+			sum(c for (s,k),c in self.counts.items() if k=="unknown"),rate)
+
+#####################################
+#
+# generate(config,devices,sink,simStart)
+#
+# publishes each device's messages when they are due until duration_secs
+# of simulated time have passed (0=for ever). With sink a FileSink there
+# is no waiting, the messages are written as fast as possible
+#
+def generate(config,devices,sink,simStart):
+	loadgen=config["loadgen"]
+	generator=random.Random(loadgen["seed"])
+	speed=loadgen["speed"]
+	waiting=not isinstance(sink,FileSink)
+	simEnd=simStart+loadgen["duration_secs"] if loadgen["duration_secs"]>0 else None
+	topic=config["broker"]["topic"]
+	stats=Stats()
+
+	queue=[]
+	for n,device in enumerate(devices):
+		heapq.heappush(queue,(nextDue(config["sources"][device["source"]],simStart,generator,first=True),n))
+
+	realStart=time.time()
+	simNow=simStart
+	nextStats=realStart+loadgen["stats_secs"]
+	try:
+		while len(queue)>0:
+			due,n=queue[0]
+			if simEnd is not None and due>=simEnd:
+				break
+			if waiting:
+				wait=realStart+(due-simStart)/speed-time.time()
+				if time.time()>=nextStats:
+					stats.log(simStart+(time.time()-realStart)*speed)
+					nextStats+=loadgen["stats_secs"]
+				if wait>0:
+					time.sleep(max(0,min(wait,nextStats-time.time(),1)))
+					continue
+
+			heapq.heappop(queue)
+			simNow=due
+			device=devices[n]
+			settings=config["sources"][device["source"]]
+			for payload in BUILDERS[device["source"]](settings,device,due,generator):
+				if generator.random()<loadgen["unknown_fraction"]:
+					payload["dev"]=loadgen["unknown_name"] % generator.randint(1,loadgen["unknown_devices"])
+					stats.add(device["source"],"unknown")
+				if generator.random()<loadgen["malformed_fraction"]:
+					data=malformed(payload,generator)
+					stats.add(device["source"],"malformed")
+				else:
+					data=json.dumps(payload).encode("UTF-8")
+					stats.add(device["source"],"sent")
+				sink.send(topic,data)
+			heapq.heappush(queue,(nextDue(settings,due,generator),n))
+	except KeyboardInterrupt:
+		log("stopped")
+	stats.log(simNow)
+	return stats
+
+
+if __name__=="__main__":
+	parser=argparse.ArgumentParser(description="synthetic device traffic for load testing")
+	parser.add_argument("--config",default=os.path.join(os.path.dirname(os.path.abspath(__file__)),"loadGen.toml"))
+	parser.add_argument("--scale",type=float,help="multiplies every source's devices")
+	parser.add_argument("--duration",type=float,help="simulated seconds to run for, 0=for ever")
+	parser.add_argument("--speed",type=float,help="simulated seconds per second")
+	parser.add_argument("--start",help="simulated start time e.g. 2026-10-18T09:59:00 (UTC), default now")
+	parser.add_argument("--register",action="store_true",help="register the devices with devManager first")
+	parser.add_argument("--register-only",action="store_true",help="register the devices with devManager and stop")
+	parser.add_argument("--ndjson",help="write the messages to this file (- for stdout) instead of publishing them")
+	args=parser.parse_args()
+
+	config=toml.load(args.config)
+	loadgen=config["loadgen"]
+	for key,value in (("scale",args.scale),("duration_secs",args.duration),("speed",args.speed)):
+		if value is not None:
+			loadgen[key]=value
+
+	devices=makeDevices(config,random.Random(loadgen["seed"]))
+	log("%s devices, %s",len(devices),", ".join("%s %s" % (source,sum(1 for d in devices if d["source"]==source))
+		for source in SOURCES if source in config["sources"]))
+
+	if args.register or args.register_only:
+		added,existed,failed=registerDevices(config,devices)
+		log("devManager: %s added, %s already registered, %s failed",added,existed,len(failed))
+		if args.register_only:
+			sys.exit(1 if len(failed)>0 else 0)
+
+	if args.start:
+		simStart=datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc).timestamp()
+	else:
+		simStart=time.time()
+
+	if args.ndjson:
+		sink=FileSink(args.ndjson)
+		if loadgen["duration_secs"]<=0:
+			sys.exit("--ndjson needs a duration")
+	else:
+		sink=MqttSink(config["broker"])
+		log("publishing to %s:%s %s at %sx real time",config["broker"]["host"],config["broker"]["port"],
+			config["broker"]["topic"],loadgen["speed"])
+	try:
+		generate(config,devices,sink,simStart)
+	finally:
+		sink.close()
@@ -0,0 +1,274 @@
+"""
+miniBroker.py
+
+Author:     Brian Norman
+Date:       18/10/2026
+Version:    1.0
+Python Ver: 3
+
+A small MQTT 3.1.1 broker used by benchIngest.py when mosquitto is not installed. It is a
+stand-in for benchmarks, not a broker to run for real:-
+
+	- no authentication, the user name and password are ignored
+	- clean sessions only, nothing is kept for a client which disconnects
+	- no retained messages, wills or QoS 1 redelivery
+	- QoS 2 is accepted from publishers but delivered as QoS 1
+
+Topic filters with + and # and shared subscriptions ($share/<group>/<filter>, messages
+are given to the group's subscribers in turn) are supported so clustered dbLoaders can
+be benchmarked too.
+
+USAGE:
+
+	import miniBroker
+
+	broker=miniBroker.Broker("127.0.0.1",0)		# 0 picks a free port
+	broker.start()
+	print(broker.port)
+	...
+	broker.stop()
+
+or on its own:-
+
+	python3 miniBroker.py [port]
+
+"""
+
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import logging
+
+CONNECT=1
+CONNACK=2
+PUBLISH=3
+PUBACK=4
+PUBREC=5
+PUBREL=6
+PUBCOMP=7
+SUBSCRIBE=8
+SUBACK=9
+UNSUBSCRIBE=10
+UNSUBACK=11
+PINGREQ=12
+PINGRESP=13
+DISCONNECT=14
+
+#####################################
+#
+# topicMatches(topicFilter,topic)
+#
+# returns True if topic matches the filter, + matches one level and
+# # matches the rest
+#
+def topicMatches(topicFilter,topic):
+	filterLevels=topicFilter.split("/")
+	topicLevels=topic.split("/")
+	for n,level in enumerate(filterLevels):
+		if level=="#":
+			return True
+		if n>=len(topicLevels):
+			return False
+		if level!="+" and level!=topicLevels[n]:
+			return False
+	return len(filterLevels)==len(topicLevels)
+
+def encodeLength(length):
+	encoded=bytearray()
+	while True:
+		byte=length%128
+		length//=128
+		if length>0:
+			byte|=0x80
+		encoded.append(byte)
+		if length==0:
+			return bytes(encoded)
+
+def encodeString(text):
+	data=text.encode("UTF-8")
+	return struct.pack("!H",len(data))+data
+
+class Broker:
+
+	def __init__(self,host="127.0.0.1",port=1883):
+		self.lock=threading.Lock()
+		self.subscriptions=[]	# [client,topic filter,qos,share group or None]
+		self.shareNext={}		# (group,filter):count, for taking turns
+		self.server=socketserver.ThreadingTCPServer((host,port),ClientHandler,bind_and_activate=False)
+		self.server.allow_reuse_address=True
+		self.server.daemon_threads=True
+		self.server.broker=self
+		self.server.server_bind()
+		self.server.server_activate()
+		self.port=self.server.server_address[1]
+		self.received=0			# messages published to us
+
+	def start(self):
+		threading.Thread(target=self.server.serve_forever,name="miniBroker",daemon=True).start()
+		logging.info("miniBroker listening on port %s",self.port)
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def subscribe(self,client,topicFilter,qos):
+		group=None
+		if topicFilter.startswith("$share/"):
+			parts=topicFilter.split("/",2)
+			if len(parts)<3:
+				return 0x80		# failure
+			group,topicFilter=parts[1],parts[2]
+		with self.lock:
+			self.subscriptions=[s for s in self.subscriptions if not (s[0] is client and s[1]==topicFilter and s[3]==group)]
+			self.subscriptions.append([client,topicFilter,min(qos,1),group])
+		return min(qos,1)
+
+	def unsubscribe(self,client,topicFilter):
+		group=None
+		if topicFilter.startswith("$share/"):
+			parts=topicFilter.split("/",2)
+			group,topicFilter=parts[1],parts[-1]
+		with self.lock:
+			self.subscriptions=[s for s in self.subscriptions if not (s[0] is client and s[1]==topicFilter and s[3]==group)]
+
+	def disconnected(self,client):
+		with self.lock:
+			self.subscriptions=[s for s in self.subscriptions if s[0] is not client]
+
+	#####################################
+	#
+	# publish(topic,payload,qos)
+	#
+	# sends the message to every matching subscriber, and to one
+	# subscriber of each matching share group
+	#
+	def publish(self,topic,payload,qos):
+		targets=[]
+		groups={}
+		with self.lock:
+			self.received+=1
+			for client,topicFilter,subQos,group in self.subscriptions:
+				if not topicMatches(topicFilter,topic):
+					continue
+				if group is None:
+					targets.append((client,min(qos,subQos)))
+				else:
+					groups.setdefault((group,topicFilter),[]).append((client,min(qos,subQos)))
+			for key,members in groups.items():
+				turn=self.shareNext.get(key,0)
+				self.shareNext[key]=turn+1
+				targets.append(members[turn%len(members)])
+		for client,deliverQos in targets:
+			client.sendPublish(topic,payload,deliverQos)
+
+class ClientHandler(socketserver.BaseRequestHandler):
+
+	def setup(self):
+		self.broker=self.server.broker
+		self.sendLock=threading.Lock()
+		self.nextId=0
+		self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+		self.stream=self.request.makefile("rb")
+
+	def send(self,packetType,flags,body):
+		with self.sendLock:
+			self.request.sendall(bytes([(packetType<<4)|flags])+encodeLength(len(body))+body)
+
+	def sendPublish(self,topic,payload,qos):
+		body=encodeString(topic)
+		if qos>0:
+			with self.sendLock:
+				self.nextId=self.nextId%65535+1
+				packetId=self.nextId
+			body+=struct.pack("!H",packetId)
+		try:
+			self.send(PUBLISH,qos<<1,body+payload)
+		except OSError:
+			pass	# the client has gone, handle() tidies up
+
+	def readPacket(self):
+		header=self.stream.read(1)
+		if len(header)==0:
+			return None,None,None
+		length=0
+		multiplier=1
+		while True:
+			byte=self.stream.read(1)
+			if len(byte)==0:
+				return None,None,None
+			length+=(byte[0]&0x7f)*multiplier
+			if byte[0]&0x80==0:
+				break
+			multiplier*=128
+		body=self.stream.read(length)
+		if len(body)<length:
+			return None,None,None
+		return header[0]>>4,header[0]&0x0f,body
+
+	def handle(self):
+		try:
+			while True:
+				packetType,flags,body=self.readPacket()
+				if packetType is None or packetType==DISCONNECT:
+					break
+				elif packetType==CONNECT:
+					self.send(CONNACK,0,b"\x00\x00")
+				elif packetType==PUBLISH:
+					self.onPublish(flags,body)
+				elif packetType==PUBREL:
+					self.send(PUBCOMP,0,body[:2])
+				elif packetType==SUBSCRIBE:
+					self.onSubscribe(body)
+				elif packetType==UNSUBSCRIBE:
+					self.onUnsubscribe(body)
+				elif packetType==PINGREQ:
+					self.send(PINGRESP,0,b"")
+				# PUBACK, PUBREC and PUBCOMP from subscribers need nothing
+		except OSError:
+			pass
+		finally:
+			self.broker.disconnected(self)
+
+	def onPublish(self,flags,body):
+		qos=(flags>>1)&3
+		topicLength=struct.unpack_from("!H",body)[0]
+		topic=body[2:2+topicLength].decode("UTF-8")
+		offset=2+topicLength
+		if qos>0:
+			packetId=body[offset:offset+2]
+			offset+=2
+			self.send(PUBACK if qos==1 else PUBREC,0,packetId)
+		self.broker.publish(topic,body[offset:],qos)
+
+	def onSubscribe(self,body):
+		packetId=body[:2]
+		offset=2
+		granted=bytearray()
+		while offset<len(body):
+			length=struct.unpack_from("!H",body,offset)[0]
+			topicFilter=body[offset+2:offset+2+length].decode("UTF-8")
+			qos=body[offset+2+length]
+			offset+=3+length
+			granted.append(self.broker.subscribe(self,topicFilter,qos))
+		self.send(SUBACK,0,packetId+bytes(granted))
+
+	def onUnsubscribe(self,body):
+		packetId=body[:2]
+		offset=2
+		while offset<len(body):
+			length=struct.unpack_from("!H",body,offset)[0]
+			self.broker.unsubscribe(self,body[offset+2:offset+2+length].decode("UTF-8"))
+			offset+=2+length
+		self.send(UNSUBACK,0,packetId)
+
+
+if __name__=="__main__":
+	logging.basicConfig(level=logging.INFO,format="%(asctime)s - %(message)s")
+	broker=Broker("127.0.0.1",int(sys.argv[1]) if len(sys.argv)>1 else 1883)
+	broker.start()
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		broker.stop()
@@ -0,0 +1,47 @@
+"""
+dbHelper.py
+
+Author:     Brian Norman
+Date:       18/10/2026
+Version:    1.0
+
+Database helpers shared by the programs in this repository. Copy this file into the same
+folder as the program, alongside Shared.toml
+
+USAGE:
+
+    import dbHelper
+
+    new_id=dbHelper.insertRow(mydb,sql,vals)
+
+"""
+
+
+##############################################################################################
+#
+# insertRow(mydb,sql,vals,commit=True,mycursor=None)
+#
+# executes an INSERT and returns the AUTO_INCREMENT id it generated
+#
+# the id comes back with the INSERT's OK packet (cursor.lastrowid) so there is no
+# extra "select last_insert_id()" or "select max(id)" round trip. Because it belongs
+# to this connection's INSERT it is correct even when other programs are inserting
+# into the same table at the same time
+#
+# mydb is a mysql.connector connection, sql uses %s or %(name)s parameters
+#
+# set commit=False if the caller commits several changes together
+#
+# mycursor can be passed to re-use a cursor, e.g. a prepared cursor, otherwise a
+# new one is created
+#
+# exceptions are not caught, the caller decides how to log them and whether to
+# roll back
+#
+def insertRow(mydb, sql, vals, commit=True, mycursor=None):
+    if mycursor is None:
+        mycursor = mydb.cursor()
+    mycursor.execute(sql, vals)
+    if commit:
+        mydb.commit()
+    return mycursor.lastrowid
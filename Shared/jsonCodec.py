@@ -0,0 +1,64 @@
+"""
+jsonCodec.py
+
+Author:     Brian Norman
+Date:       18/10/2026
+Version:    1.0
+
+JSON encoding and decoding shared by the programs in this repository. Copy this file into the
+same folder as the program.
+
+orjson is used if it is installed (pip3 install orjson), it is several times faster than the
+json module. Otherwise the json module is used. Either way:-
+
+    loads() accepts the MQTT payload bytes as they arrive (or a str), there is no need to
+            decode it first
+    dumps() returns compact JSON as a str
+    dumpb() returns compact JSON as UTF-8 bytes, ready for mqttc.publish()
+
+Invalid JSON raises ValueError (json.JSONDecodeError and orjson.JSONDecodeError are both
+ValueErrors). NaN, Infinity and -Infinity are not JSON and loads() rejects them with either
+library, the json module would otherwise accept them. dumps() differs: orjson writes a float
+NaN or infinity as null, the json module writes NaN/Infinity
+
+USAGE:
+
+    import jsonCodec
+
+    payloadJson=jsonCodec.loads(msg.payload)
+    mqttc.publish(topic,jsonCodec.dumpb(reply))
+
+"""
+
+import json
+
+try:
+    import orjson
+
+    NAME = "orjson"
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("UTF-8")
+
+    def dumpb(obj):
+        return orjson.dumps(obj)
+
+except ImportError:
+
+    NAME = "json"
+
+    def _rejectConstant(name):
+        raise ValueError("invalid JSON constant " + name)
+
+    def loads(data):
+        # json.loads() works out the encoding of bytes itself
+        return json.loads(data, parse_constant=_rejectConstant)
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+    def dumpb(obj):
+        return dumps(obj).encode("UTF-8")
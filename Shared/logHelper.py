@@ -0,0 +1,139 @@
+"""
+logHelper.py
+
+Author:     Brian Norman
+Date:       18/10/2026
+Version:    1.0
+
+Logging setup shared by the programs in this repository. Copy this file into the same
+folder as the program, alongside Shared.toml
+
+Log records are put on a queue and written to the log file by a background thread so the
+program never waits for the disk. Levels come from the [logging] table in Shared.toml:-
+
+    [logging]
+        level="INFO"                # root level
+        background=true             # false writes the log file on the calling thread
+        [logging.loggers]
+            "dbLoader.job"="WARNING"    # per logger levels
+        [logging.rate_limits]
+            "dbLoader.job"=20           # max INFO/DEBUG records per second
+            "dbLoader.reject"={per_second=5,level="ERROR"}   # ERROR and below
+
+USAGE:
+
+    import logHelper
+
+    logHelper.setup(logFile,format,shared.get("logging"))
+    jobLog=logging.getLogger("dbLoader.job")
+    jobLog.info("process_job(%s): readings_id=%s",msg_num,readings_id)
+
+Use %s style arguments rather than f-strings or str() so nothing is formatted unless the
+record is going to be written. Formatting happens on the background thread, so don't
+change an argument after passing it to the logger.
+
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+##############################################################################################
+#
+# setup(logFile,format,settings=None)
+#
+# replaces logging.basicConfig(). logFile None logs to stderr
+#
+# settings is the [logging] table from Shared.toml, None gives the
+# old behaviour (DEBUG) but still writes in the background
+#
+def setup(logFile, format, settings=None):
+    if settings is None:
+        settings = {}
+
+    if logFile is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(logFile)
+    handler.setFormatter(logging.Formatter(format))
+
+    root = logging.getLogger()
+    root.setLevel(settings.get("level", "DEBUG"))
+
+    if settings.get("background", True):
+        log_queue = queue.SimpleQueue()
+        root.addHandler(_QueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        # write whatever is still queued when the program exits
+        atexit.register(listener.stop)
+    else:
+        root.addHandler(handler)
+
+    for name, level in settings.get("loggers", {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    for name, limit in settings.get("rate_limits", {}).items():
+        if isinstance(limit, dict):
+            logging.getLogger(name).addFilter(RateLimit(limit["per_second"], limit.get("level", "INFO")))
+        else:
+            logging.getLogger(name).addFilter(RateLimit(limit))
+
+
+##############################################################################################
+#
+# _QueueHandler
+#
+# the standard QueueHandler formats the message before queueing it. This
+# one leaves that to the background thread. Tracebacks are turned into
+# text here because the frames can change once the exception is handled
+#
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_formatter = logging.Formatter()
+
+
+##############################################################################################
+#
+# RateLimit(per_second,level="INFO")
+#
+# logging filter which lets through at most per_second records at level or
+# below each second. The rest are counted and the number dropped is added to
+# the next record written. Records above level are always written
+#
+class RateLimit(logging.Filter):
+
+    def __init__(self, per_second, level="INFO"):
+        super().__init__()
+        self.per_second = per_second
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+        self.second = 0
+        self.count = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        with self.lock:
+            second = int(record.created)
+            if second != self.second:
+                self.second = second
+                self.count = 0
+            self.count += 1
+            if self.count > self.per_second:
+                self.suppressed += 1
+                return False
+            if self.suppressed > 0:
+                record.msg = str(record.msg) + " [%d earlier messages not logged]" % self.suppressed
+                self.suppressed = 0
+        return True
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+"""
+benchJson.py
+
+Authors: Brian Norman
+Date: 18/10/2026
+Version: 1.0
+Python Ver: 3
+
+Compares the per message cost of decoding MQTT payloads the old way (payload.decode("UTF-8") then
+json.loads) with jsonCodec.loads() straight from the payload bytes, and of encoding with json.dumps
+against jsonCodec.dumps()
+
+The payloads are a TTN V3 uplink, as received by hccSensorBridge, and the message it publishes
+to dbLoader. jsonCodec.py must be in the same folder (copy it from the Shared folder)
+
+usage:
+	python3 benchJson.py [messages]
+
+"""
+
+import sys
+import time
+import json
+import jsonCodec
+
+# a real TTN V3 uplink (ids changed)
+TTN_UPLINK=b'{"end_device_ids":{"device_id":"hcc-aq-0042","application_ids":{"application_id":"hull-aq"},' \
+	b'"dev_eui":"70B3D57ED0041A2C","join_eui":"0000000000000000","dev_addr":"260B5A3F"},' \
+	b'"correlation_ids":["as:up:01FJ5Q3X2M8Y0N7V6GZ4P1KQWE","gs:conn:01FJ2ZQ9W0B7J4T3D5V8XKMN2C",' \
+	b'"gs:up:host:01FJ2ZQ9W3R8E6Y1H0C4NPL7SA","gs:uplink:01FJ5Q3X1T2B5G8K0W3D6FHY9J",' \
+	b'"ns:uplink:01FJ5Q3X1V4C7J0M2Q5S8TWX3B","rpc:/ttn.lorawan.v3.GsNs/HandleUplink:01FJ5Q3X1V0A3D6G9J2M5PRS8V"],' \
+	b'"received_at":"2021-10-21T10:11:12.345678901Z","uplink_message":{"session_key_id":"AXyJ3kQ2b5pZ9rT1mW8vCg==",' \
+	b'"f_port":1,"f_cnt":18342,"frm_payload":"AOwBkgPwABcAIQ==","decoded_payload":{"celcius":23.6,"humidity":40.2,' \
+	b'"mbar":1008,"pm_10":2.3,"pm_25":3.3},"rx_metadata":[{"gateway_ids":{"gateway_id":"hull-gw-01","eui":"B827EBFFFE8B6C21"},' \
+	b'"time":"2021-10-21T10:11:12.123456Z","timestamp":2889172340,"rssi":-97,"channel_rssi":-97,"snr":8.25,' \
+	b'"location":{"latitude":53.7446,"longitude":-0.3352,"altitude":12,"source":"SOURCE_REGISTRY"},' \
+	b'"uplink_token":"ChgKFgoKaHVsbC1ndy0wMRIIuCfr//6LbCEQ9P6IygoaDAjQmcaLBhCg9IWqAyCgqt7qzKwg","channel_index":2},' \
+	b'{"gateway_ids":{"gateway_id":"hull-gw-04","eui":"B827EBFFFE12A9F0"},"time":"2021-10-21T10:11:12.124001Z",' \
+	b'"timestamp":1203481177,"rssi":-112,"channel_rssi":-112,"snr":-3.5,"uplink_token":"ChgKFgoKaHVsbC1ndy0wNBII' \
+	b'uCfr//4SqfAQ2a6w8QQaDAjQmcaLBhDA0YuqAyCIuPKmp6Eh","channel_index":2}],"settings":{"data_rate":{"lora":' \
+	b'{"bandwidth":125000,"spreading_factor":7}},"coding_rate":"4/5","frequency":"868500000","timestamp":2889172340,' \
+	b'"time":"2021-10-21T10:11:12.123456Z"},"received_at":"2021-10-21T10:11:12.135792468Z","consumed_airtime":"0.056576s",' \
+	b'"network_ids":{"net_id":"000013","tenant_id":"ttn","cluster_id":"ttn-eu1"}}}'
+
+# what hccSensorBridge publishes for dbLoader
+CH_MESSAGE={"dev":"hcc-aq-0042","temp":23.6,"humidity":40.2,"pressure":1008,"PM10":2.3,"PM25":3.3,"RSSI":-97,
+	"gtw_id":"hull-gw-01","timestamp":"2021-10-21T10:11:12.135792468Z"}
+
+#####################################
+#
+# perMessage(fn,count)
+#
+# returns the time for one call of fn in microseconds
+#
+def perMessage(fn,count):
+	for n in range(100):	# warm up
+		fn()
+	start=time.perf_counter()
+	for n in range(count):
+		fn()
+	return (time.perf_counter()-start)*1e6/count
+
+
+if __name__=="__main__":
+	count=int(sys.argv[1]) if len(sys.argv)>1 else 20000
+	ch_bytes=json.dumps(CH_MESSAGE).encode("UTF-8")
+
+	tests=[
+		("decode TTN uplink",
+			lambda: json.loads(TTN_UPLINK.decode("UTF-8")),
+			lambda: jsonCodec.loads(TTN_UPLINK)),
+		("decode dbLoader message",
+			lambda: json.loads(ch_bytes.decode("UTF-8")),
+			lambda: jsonCodec.loads(ch_bytes)),
+		("encode dbLoader message",
+			lambda: json.dumps(CH_MESSAGE),
+			lambda: jsonCodec.dumps(CH_MESSAGE)),
+	]
+
+	print(f"{count} messages, jsonCodec is using {jsonCodec.NAME}, per message times in microseconds")
+	print(f"{'':26} {'json':>8} {jsonCodec.NAME:>8} {'speedup':>8}")
+	for name,old,new in tests:
+		oldUs=perMessage(old,count)
+		newUs=perMessage(new,count)
+		print(f"{name:26} {oldUs:8.2f} {newUs:8.2f} {oldUs/newUs:7.1f}x")
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+benchPrepared.py
+
+Authors: Brian Norman
+Date: 18/10/2026
+Version: 1.0
+Python Ver: 3
+
+Compares the per message cost of dbLoader's hot path SQL (readings insert, multi-row reading_values insert
+and devices update) using ordinary cursors and server side prepared statements (prepared=true in dbLoader.toml)
+
+Uses the database in Shared.toml. Everything is done inside a transaction which is rolled back at the end so
+nothing is left in the database. The first device in the devices table and the first reading_value_types are used.
+
+usage:
+	python3 benchPrepared.py [messages] [values per message]
+
+Reports, per message:
+	client_cpu_us	- python process CPU time (time.process_time)
+	wall_us			- elapsed time
+	server_cpu_us	- server CPU from SHOW PROFILE data for a sample of 25 messages (if profiling is available)
+
+"""
+
+import sys
+import time
+import datetime
+import itertools
+import toml
+import mysql.connector
+
+sharedFile="Shared.toml"
+
+READINGS_SQL = "INSERT INTO readings (storedon,recordedon,device_id,raw_json,reading_latitude,reading_longitude," \
+			   "reading_altitude) values (now(),%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE id=id"
+LAST_SEEN_SQL = "update devices set last_seen=%s, visible=1 where device_id=%s"
+
+PROFILE_SAMPLE=25		# 3 statements each, profiling_history_size is at most 100
+
+# every reading gets its own recordedon, one second apart, so none of them
+# hit the (device_id,recordedon) unique key. Well before any real readings
+BENCH_START=datetime.datetime(2000,1,1)
+benchSeconds=itertools.count()
+
+#####################################
+#
+# runMessages(mydb,prepared,count,device_id,type_ids)
+#
+# executes the three hot path statements count times the way dbLoader does
+#
+def runMessages(mydb,prepared,count,device_id,type_ids):
+	values_sql="INSERT INTO reading_values (reading_id, value, reading_value_types_id) VALUES "+",".join(["(%s,%s,%s)"]*len(type_ids))
+	cursors={}
+	for sql in (READINGS_SQL,values_sql,LAST_SEEN_SQL):
+		cursors[sql]=mydb.cursor(prepared=True) if prepared else None
+
+	def cursor(sql):
+		return cursors[sql] if prepared else mydb.cursor()
+
+	for n in range(count):
+		recordedOn=BENCH_START+datetime.timedelta(seconds=next(benchSeconds))
+		c=cursor(READINGS_SQL)
+		c.execute(READINGS_SQL,(recordedOn,device_id,'{"dev":"bench"}',None,None,None))
+		reading_id=c.lastrowid
+		vals=[]
+		for type_id in type_ids:
+			vals+=[reading_id,n*0.1,type_id]
+		cursor(values_sql).execute(values_sql,vals)
+		cursor(LAST_SEEN_SQL).execute(LAST_SEEN_SQL,(recordedOn,device_id))
+
+#####################################
+#
+# bench(mydb,prepared,count,device_id,type_ids)
+#
+# returns a dictionary of per message costs in microseconds
+#
+def bench(mydb,prepared,count,device_id,type_ids):
+	mydb.start_transaction()
+	try:
+		# warm up, this also prepares the statements
+		runMessages(mydb,prepared,10,device_id,type_ids)
+
+		startCpu=time.process_time()
+		startWall=time.perf_counter()
+		runMessages(mydb,prepared,count,device_id,type_ids)
+		result={
+			"client_cpu_us": (time.process_time()-startCpu)*1e6/count,
+			"wall_us": (time.perf_counter()-startWall)*1e6/count,
+			"server_cpu_us": None
+		}
+
+		# server side cost from the profiler
+		try:
+			mycursor=mydb.cursor()
+			mycursor.execute("SET profiling_history_size=100")
+			mycursor.execute("SET profiling=1")
+			runMessages(mydb,prepared,PROFILE_SAMPLE,device_id,type_ids)
+			mycursor.execute("SET profiling=0")
+			mycursor.execute("SELECT sum(CPU_USER+CPU_SYSTEM) FROM information_schema.PROFILING")
+			cpu=mycursor.fetchone()[0]
+			if cpu is not None:
+				result["server_cpu_us"]=float(cpu)*1e6/PROFILE_SAMPLE
+		except mysql.connector.Error as e:
+			print("server profiling not available:",e)
+
+		return result
+	finally:
+		mydb.rollback()
+
+
+if __name__=="__main__":
+	count=int(sys.argv[1]) if len(sys.argv)>1 else 1000
+	numValues=int(sys.argv[2]) if len(sys.argv)>2 else 8
+
+	shared=toml.load(sharedFile)
+	mydb=mysql.connector.connect(
+		host=shared["database"]["host"],
+		port=shared["database"].get("port",3306),
+		user=shared["database"]["user"],
+		passwd=shared["database"]["passwd"],
+		database=shared["database"]["dbname"]
+	)
+
+	mycursor=mydb.cursor()
+	mycursor.execute("SELECT device_id FROM devices LIMIT 1")
+	device_id=mycursor.fetchone()[0]
+	mycursor.execute("SELECT id FROM reading_value_types ORDER BY id LIMIT %s",(numValues,))
+	type_ids=[row[0] for row in mycursor.fetchall()]
+
+	print(f"{count} messages, {len(type_ids)} values per message, per message costs in microseconds")
+	print(f"{'cursor':10} {'client_cpu_us':>14} {'server_cpu_us':>14} {'wall_us':>10}")
+	for prepared in (False,True):
+		r=bench(mydb,prepared,count,device_id,type_ids)
+		server="n/a" if r["server_cpu_us"] is None else f"{r['server_cpu_us']:.1f}"
+		print(f"{'prepared' if prepared else 'plain':10} {r['client_cpu_us']:14.1f} {server:>14} {r['wall_us']:10.1f}")
+
+	mydb.close()
@@ -4,19 +4,22 @@ dbLoader.py
 
 Authors: Brian Norman
 Date: 22nd March 2021
-Version: 3.00
+Version: 3.24
 Python Ver: 3
 
-This program receives MQTT messages with a JSON payload from a broker. Messages are added to a queue of jobs
-and processed sequentially in the main thread.
+This program receives MQTT messages with a JSON payload from a broker. Messages are added to a queue of jobs.
+The main thread hands each job to one of a pool of worker threads, each with its own database connection.
+All the messages from one device go to the same worker so they are stored in the order received.
 
 The JSON keys MUST include a "dev" which is the unique device identifer. If it is missing or unknown
 the message is ignored
 
 "timestamp" is optional but should be the timestamp for the readings.
 
-Other valid keys are listed in the reading_value_types database table which is read when this program starts. If new types are added
-this program should be restarted (systemctl restart dbLoader)
+Other valid keys are listed in the reading_value_types database table which is read when this program starts. The table
+is checked for changes every types_check_secs seconds and re-read if it has changed. Sending SIGHUP
+(systemctl reload dbLoader) re-reads the table and the aliases in dbLoader.toml straight away. There is
+no need to restart the program, which would lose any queued messages.
 
 There are two possible timestamps in the database. The one sent with the JSON is the date/time when the message was 'recorded on'
 by the device. The second is the date/time the data was 'stored on' (into the database) The Sensors Map
@@ -24,21 +27,45 @@ https://sensors.connectedhumber.org/app/ uses these timestamps to display data.
 
 configuration information is in dbLoader.toml and Shared.toml
 
+Several instances can share the load using an MQTT shared subscription, see [cluster] in dbLoader.toml.
+
+--backfill loads a file of messages, or a spool folder, straight into the database without the broker
+e.g. to import a new source's history or catch up after an outage, see backfill().
+
+usage:
+	python3 dbLoader.py [--instance NAME]
+	python3 dbLoader.py --backfill FILE|SPOOL_FOLDER
+
 See changelog.md for changes
 """
 
 
 import sys
+import argparse
+import socket
 import paho.mqtt.client as paho
 from dateutil.parser import *
 import pytz
-from datetime import datetime
+from datetime import datetime,timedelta,timezone
+import re
+import math
 import mysql.connector
+import mysql.connector.pooling
+import threading
 import time
-import json
 import logging
 import os
+import signal
 import toml
+import functools
+import zlib
+import base64
+import collections
+import dbHelper		# from the Shared folder
+import logHelper	# from the Shared folder
+import jsonCodec	# from the Shared folder
+import spool
+import metrics
 
 if int(sys.version[0])>=3:
 	import queue
@@ -46,18 +73,43 @@ else:
 	import Queue as queue
 
 
-VERSION="3.00"	# used for logging
+VERSION="3.24"	# used for logging
 print("running on python ",sys.version[0])
 
 # define the config files
 configFile="dbLoader.toml"
 sharedFile="Shared.toml"
 
+parser=argparse.ArgumentParser(description="Loads MQTT sensor messages into the database")
+parser.add_argument("--instance",default=socket.gethostname(),help="name of this instance when clustered (default: host name)")
+parser.add_argument("--backfill",metavar="PATH",help="load a newline delimited JSON file (- for stdin) or a spool folder into the database and exit")
+args=parser.parse_args()
+
+#####################################
+#
+# mergeSettings(config,overrides)
+#
+# copies overrides into config, tables are merged key by key
+#
+def mergeSettings(config,overrides):
+	for key,value in overrides.items():
+		if isinstance(value,dict) and isinstance(config.get(key),dict):
+			mergeSettings(config[key],value)
+		else:
+			config[key]=value
+
 # get config info
 try:
 	config=toml.load(configFile)
 	shared=toml.load(sharedFile)
 
+	# each clustered instance can have its own settings
+	CLUSTERED = config["cluster"]["enabled"]
+	INSTANCE = args.instance
+	if CLUSTERED:
+		mergeSettings(config,config["cluster"]["instances"].get(INSTANCE,{}))
+	SHARE_GROUP = config["cluster"]["group"]
+
 	debug=config["debug"]["settings"]["debug"]
 
 	if debug:
@@ -67,22 +119,26 @@ try:
 		logFile = config["settings"]["logfile"]
 		pidFile = config["settings"]["pidfile"]
 
-	# logging
-	logging.basicConfig(filename=logFile, format='%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', level=logging.DEBUG)
+	# logging, levels are in Shared.toml [logging]
+	logHelper.setup(logFile, '%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s', shared.get("logging"))
 	logging.info("############################### ")
 	logging.info(f"Starting dbLoader Vsn: {VERSION}")
 
 	logging.info(f"debug={debug}, logFile={logFile} , pidFile={pidFile}")
+	if CLUSTERED:
+		logging.info(f"clustered instance {INSTANCE} in group {SHARE_GROUP}")
 
 	# mqtt
 	mqttTopic = shared["mqtt"]["topic"]
 	mqttClientUser = shared["mqtt"]["user"]
 	mqttClientPassword = shared["mqtt"]["passwd"]
 	mqttBroker = shared["mqtt"]["host"]
+	mqttPort = shared["mqtt"].get("port",1883)
 	mqttKeepAlive = shared["mqtt"]["keepAlive"]
 	mqttConnectTimeout = shared["mqtt"]["connectTimeout"]
 	# database
 	dbHost = shared["database"]["host"]
+	dbPort = shared["database"].get("port",3306)
 	dbUser = shared["database"]["user"]
 	dbPassword = shared["database"]["passwd"]
 	dbName = shared["database"]["dbname"]
@@ -92,7 +148,72 @@ try:
 
 	MAX_JOBS = config["settings"]["max_jobs"]
 	MAX_MESSAGE_NUMBER = config["settings"]["max_message_number"]
+	BATCH_SIZE = config["settings"]["batch_size"]
+	BATCH_MS = config["settings"]["batch_ms"]
+	TYPES_CHECK_SECS = config["settings"]["types_check_secs"]
+	LAST_SEEN_SECS = config["settings"]["last_seen_secs"]
+	USE_PREPARED = config["settings"]["prepared"]
+	WORKERS = config["settings"]["workers"]
+	DEDUP_WINDOW = config["settings"]["dedup_window"]
+	RAW_JSON = config["settings"]["raw_json"]
+	RAW_JSON_COMPRESS = config["settings"]["raw_json_compress"]
+	if RAW_JSON not in ("original","compact"):
+		raise ValueError(f"unknown raw_json setting {RAW_JSON}")
 	type_aliases = config["reading_value_types_aliases"]
+	IGNORED_KEYS = config["ignored_keys"]["keys"]
+
+	# device registry
+	UNKNOWN_DEVICE_TTL = config["device_registry"]["unknown_ttl"]
+	UNKNOWN_DEVICE_MAX = config["device_registry"]["unknown_max"]
+	devMgrReplyTopic = config["device_registry"]["reply_topic"]
+
+	# what on_message() does when the job_queue is full
+	OVERFLOW_POLICY = config["overflow"]["policy"]
+	OVERFLOW_BLOCK_MS = config["overflow"]["block_ms"]
+	SPILL_FILE = config["overflow"]["spill_file"]
+	if OVERFLOW_POLICY not in ("block","drop_oldest","drop_newest","spill"):
+		raise ValueError(f"unknown overflow policy {OVERFLOW_POLICY}")
+
+	# on-disk spool
+	SPOOL_ENABLED = config["spool"]["enabled"]
+	SPOOL_DIR = config["spool"]["directory"]
+	SPOOL_SEGMENT_MB = config["spool"]["segment_mb"]
+	SPOOL_CHECKPOINT_MS = config["spool"]["checkpoint_ms"]
+	SPOOL_FSYNC_MS = config["spool"]["fsync_ms"]
+
+	# MQTT session
+	PERSISTENT_SESSION = config["mqtt_session"]["persistent"]
+	MQTT_CLIENT_ID = config["mqtt_session"]["client_id"]
+	MQTT_QOS = config["mqtt_session"]["qos"] if PERSISTENT_SESSION else 0
+	if CLUSTERED:
+		# instances share the messages, the broker gives each one to only one of us
+		subscribeTopic = f"$share/{SHARE_GROUP}/{mqttTopic}"
+		MQTT_CLIENT_ID = f"{MQTT_CLIENT_ID}-{INSTANCE}"
+	else:
+		subscribeTopic = mqttTopic
+	if PERSISTENT_SESSION and not hasattr(paho,"CallbackAPIVersion"):
+		raise ValueError("[mqtt_session] persistent=true needs paho-mqtt 2.0 or later")
+	if PERSISTENT_SESSION and OVERFLOW_POLICY not in ("block","spill"):
+		# a dropped message would never be acknowledged, see queueJob()
+		raise ValueError(f"[mqtt_session] persistent=true needs [overflow] policy block or spill, not {OVERFLOW_POLICY}")
+
+	# ingest lag
+	LAG_DEVICE_WINDOW = config["lag"]["device_window"]
+	LAG_SOURCE_WINDOW = config["lag"]["source_window"]
+	LAG_WARN_SECS = config["lag"]["warn_secs"]
+	LAG_DEFAULT_SOURCE = config["lag"]["default_source"]
+	# longest prefix first so "CL-" wins over "C"
+	LAG_SOURCES = sorted(config["lag"]["sources"].items(),key=lambda item: -len(item[0]))
+
+	# Prometheus /metrics
+	METRICS_ENABLED = config["metrics"]["enabled"]
+	METRICS_HOST = config["metrics"]["host"]
+	METRICS_PORT = config["metrics"]["port"]
+
+	# --backfill
+	BACKFILL_CHUNK = config["backfill"]["chunk"]
+	BACKFILL_INSERT_ROWS = config["backfill"]["insert_rows"]
+	BACKFILL_PROGRESS_SECS = config["backfill"]["progress_secs"]
 
 except KeyError as e:
 	sys.exit(f"logfile entry missing:{e}")
@@ -101,17 +222,19 @@ except Exception as e:
 	sys.exit(f"Unable to load settings from configFile error was {e}")
 
 logging.info("Settings loaded ok")
+logging.info("JSON codec %s",jsonCodec.NAME)
 
 
 
-# create PID file for monitoring
-try:
-	pid_file = open(pidFile, "w")
-	pid_file.write(str(os.getpid()))
-	pid_file.close()
-except Exception as e:
-	# this is not fatal
-	logging.error(f"Error writing to {pidFile}, Error: {e}")
+# create PID file for monitoring, not for a --backfill alongside the running dbLoader
+if not args.backfill:
+	try:
+		pid_file = open(pidFile, "w")
+		pid_file.write(str(os.getpid()))
+		pid_file.close()
+	except Exception as e:
+		# this is not fatal
+		logging.error(f"Error writing to {pidFile}, Error: {e}")
 
 if debug:
 	sys.exit()
@@ -120,116 +243,465 @@ if debug:
 
 
 
-mydb=None				# global variable required
+dbPool=None				# mysql.connector connection pool, one connection per worker plus the main thread
 message_number=0		# for trackinmg log messages for each on_message
 brokerConnected=False
+connectEvent=threading.Event()	# set by on_connect(), see waitForConnect()
 mqttc=None
-types_id={}				# populated from the database, manually restart service if changes
-
-# circular buffer (FIFO) for on_message callbacks to process
+key_map={}				# payload key:(type_id,gnss field), built by getTypeIds(), replaced when the table changes
+typesChecksum=None		# CHECKSUM TABLE reading_value_types when key_map was built
+nextTypesCheck=0		# time.time() of the next reading_value_types check
+reloadTypes=False		# set by SIGHUP
+batch_last_seen={}		# device_id:s_or_r for the batch being written, see updateLastSeen()
+pending_last_seen={}	# device_id:s_or_r committed readings waiting for flushLastSeen()
+last_seen_lock=threading.Lock()	# workers add to pending_last_seen, the main thread flushes it
+nextLastSeenFlush=0		# time.time() of the next flushLastSeen()
+devices_id={}			# device_name:device_id populated from the database by getDeviceIds()
+unknown_devices={}		# device_name:expiry time, unregistered names are not looked up again till expiry
+registry_lock=threading.Lock()	# held for every read or change of unknown_devices
+
+# circular buffer (FIFO) of (payload,done) for on_message callbacks to process
+# None wakes the main loop
 job_queue=queue.Queue(MAX_JOBS)
 
+# job_queue overflow, see queueJob()
+overflow_counts={"full":0,"block_timeouts":0,"dropped_oldest":0,"dropped_newest":0,"spilled":0,"unspilled":0}
+lastOverflowCounts=dict(overflow_counts)	# what was last logged by logStats()
+nextStatsLog=0			# time.time() of the next logStats()
+
+# workers add to rejected_counts, duplicate_counts, unknown_keys and bad_values,
+# logStats() and the metrics thread read them, see copyCounts()
+counts_lock=threading.Lock()
+
+# messages not written by reason, see countRejected()
+rejected_counts=collections.Counter()
+lastRejectedCounts={}	# what was last logged by logStats()
+
+# repeated readings, see isDuplicate()
+duplicate_counts={"memory":0,"database":0}
+lastDuplicateCounts=dict(duplicate_counts)	# what was last logged by logStats()
+
+# ingest lag, recordedon to storedon, see recordLags()
+lag_lock=threading.Lock()
+device_lags={}			# device name:deque of recent lags in seconds
+source_lags={}			# source:deque of recent lags in seconds
+device_sources={}		# device name:source, see getSource()
+lagWarnings=set()		# sources over LAG_WARN_SECS when logStats() last looked
+LAG_QUANTILES=(0.5,0.9,0.99)
+
+# payload keys not in key_map, see countUnknownKey()
+UNKNOWN_KEYS_MAX=100
+unknown_keys=collections.Counter()
+lastUnknownKeys={}		# what was last logged by logStats()
+
+# mapped payload keys whose value is not a number, see isNumeric()
+bad_values=collections.Counter()
+lastBadValues={}		# what was last logged by logStats()
+spill_lock=threading.Lock()	# on_message() appends to the spill file, the main thread reads it back
+spillFile=None			# opened by spillJob()
+spillPending=0			# jobs in the spill file not yet read back by unspillJobs()
+spillOffset=0			# read position in the spill file
+
+mySpool=None			# spool.Spool when [spool] is enabled, on_message() appends to it
+nextSpoolCheckpoint=0	# time.time() of the next mySpool.saveCheckpoint()
+nextSpoolSync=0			# time.time() of the next mySpool.sync()
+
+# PUBACKs for QoS 1 messages when PERSISTENT_SESSION, see ackJob()
+ack_lock=threading.Lock()
+ackReceived=0			# QoS 1 messages received on this connection
+ackNext=0				# the next one to acknowledge, PUBACKs are sent in the order received
+ack_ready={}			# received number:mid of messages done out of order
+ackConnection=0			# bumped by on_connect(), acks for an earlier connection are dropped
+
+# one queue per worker thread, see dispatchJob()
+worker_queues=[queue.Queue(MAX_JOBS) for n in range(WORKERS)]
+
+# per thread state. Each worker (and the main thread) has its own
+# database connection (mydb), prepared cursors (stmt_cursors, stmt_connection_id),
+# the message being processed (payloadJson) and batch_last_seen
+worker=threading.local()
+
+# per message log records, the level and rate limit are in Shared.toml [logging]
+jobLog=logging.getLogger("dbLoader.job")
+# per message errors (bad payloads, failed writes), rate limited at ERROR too so a
+# broken sensor can't flood the log. The totals are logged by logStats()
+rejectLog=logging.getLogger("dbLoader.reject")
+
+# hot path SQL, see getCursor()
+# the unique key on readings (device_id,recordedon) makes a repeated message a no-op,
+# no rows affected. Unlike INSERT IGNORE any other error is still an error
+READINGS_SQL = "INSERT INTO readings (storedon,recordedon,device_id,raw_json,reading_latitude,reading_longitude," \
+			   "reading_altitude) values (now(),%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE id=id"
+LAST_SEEN_SQL = "update devices set last_seen=%s, visible=1 where device_id=%s"
+# --backfill, see writeBackfill()
+BACKFILL_READINGS_SQL = "INSERT INTO readings (storedon,recordedon,device_id,raw_json,reading_latitude,reading_longitude," \
+			   "reading_altitude) VALUES %s ON DUPLICATE KEY UPDATE id=id"
+BACKFILL_LAST_SEEN_SQL = "update devices set last_seen=%s, visible=1 where device_id=%s and (last_seen is null or last_seen<%s)"
+values_sql={}			# number of rows:multi-row reading_values INSERT, see getValuesSql()
+
+stmt_cursors={}			# sql:prepared cursor for the current database connection
+stmt_connection_id=None	# mydb.connection_id the prepared cursors belong to
+
+# process_job() return values
+JOB_WRITTEN="written"	# rows added, waiting for the batch commit
+JOB_SKIPPED="skipped"	# nothing written e.g. bad JSON or unknown device
+JOB_FAILED="failed"		# a database write failed, the transaction must be rolled back
+
+# instrumentation, served on /metrics when [metrics] is enabled. Until then
+# these do nothing, see metrics.py
+STAGE_SECONDS=metrics.Histogram("dbloader_stage_seconds","time spent in each stage of loading a message","stage")
+RECEIVED=metrics.Meter("dbloader_messages_received","messages received from the broker")
+WRITTEN=metrics.Meter("dbloader_readings_written","readings committed to the database")
+REJECTED=metrics.Counter("dbloader_rejected_total","messages not written","reason")
+metrics.Gauge("dbloader_queue_depth","messages waiting",lambda: {
+	"job_queue":job_queue.qsize(),
+	"workers":sum(q.qsize() for q in worker_queues),
+	"spool":mySpool.pending() if mySpool is not None else 0,
+	"spill":spillPending},"queue")
+metrics.Gauge("dbloader_overflow_total","job_queue overflow events",lambda: dict(overflow_counts),"event",type="counter")
+metrics.Gauge("dbloader_duplicates_total","repeated readings skipped",lambda: copyCounts(duplicate_counts),"found_in",type="counter")
+metrics.Gauge("dbloader_unknown_keys_total","payload keys ignored because they are not mapped",lambda: sum(copyCounts(unknown_keys).values()),type="counter")
+metrics.Gauge("dbloader_bad_values_total","payload values ignored because they are not numbers",lambda: sum(copyCounts(bad_values).values()),type="counter")
+metrics.Gauge("dbloader_devices","devices in the registry",lambda: len(devices_id))
+metrics.Gauge("dbloader_unknown_devices","unregistered device names remembered",lambda: len(unknown_devices))
+metrics.Gauge("dbloader_lag_seconds","recordedon to storedon for recent readings by source",lambda: lagMetrics(source_lags),("source","quantile"))
+metrics.Gauge("dbloader_device_lag_seconds","recordedon to storedon for recent readings by device",lambda: lagMetrics(device_lags),("device","quantile"))
+metrics.Gauge("dbloader_lag_warning","1 if the source's 90th percentile lag is over warn_secs",lambda: lagWarning(),"source")
+
 thisScript=os.path.basename(__file__)
 
 print("Starting to run ",thisScript,VERSION)		# useful for when the task is first started
 logging.info("#############################")	# make it easy to see the restart
 logging.info("%s Version %s begins",thisScript,VERSION)
 
+#####################################
+#
+# dbUpdate(msg_num,sql,vals)
+#
+# inserts a row and returns the new id, 0 if the INSERT's ON DUPLICATE KEY
+# UPDATE found the row already there, or None
+#
+# NOTE: does not commit. writeBatch() commits once when the readings,
+# reading_values and devices rows for every job in the batch have been written
+#
 def dbUpdate(msg_num,sql, vals):
-	global mydb
 
-	logging.info("dbUpdate(%s): SQL=%s vals=%s",msg_num,sql,str(vals))
-	last_insert_id=None
+	jobLog.info("dbUpdate(%s): SQL=%s vals=%s",msg_num,sql,vals)
 	try:
-		# execute SQL to insert a row
-		mycursor=mydb.cursor()
-		mycursor.execute(sql, vals) # add sql to return last_insert_id()
-		# commit the change
-		mydb.commit()
-		mycursor.execute("select last_insert_id()")
-		last_insert_id=mycursor.fetchone()[0]	# return last_insert_id
-		return last_insert_id
+		# execute SQL to insert a row, the new id comes back with the insert
+		mycursor=getCursor(sql)
+		new_id=dbHelper.insertRow(worker.mydb, sql, vals, commit=False, mycursor=mycursor)
+		return new_id if mycursor.rowcount>0 else 0
 	except Exception as e:
-		logging.exception("dbUpdate(): failed to insert record.")
+		rejectLog.exception("dbUpdate(): failed to insert record.")
 		return None
 
+#####################################
+#
+# getCursor(sql)
+#
+# returns a cursor to execute sql with
+#
+# if prepared=true in dbLoader.toml each hot path statement gets its own
+# prepared cursor. The statement is prepared by the server on first use
+# and re-used after that, mysql.connector only re-prepares if a different
+# sql string object is passed, so callers use the module level constants
+#
+# prepared statements belong to the server session. If worker.mydb.ping() has
+# reconnected the connection_id changes and the cursors are created again
+#
+def getCursor(sql):
+
+	if not USE_PREPARED:
+		return worker.mydb.cursor()
+
+	if worker.mydb.connection_id!=worker.stmt_connection_id:
+		if worker.stmt_connection_id is not None:
+			logging.info("getCursor(): database reconnected, statements will be prepared again")
+		worker.stmt_cursors={}
+		worker.stmt_connection_id=worker.mydb.connection_id
+
+	mycursor=worker.stmt_cursors.get(sql)
+	if mycursor is None:
+		mycursor=worker.mydb.cursor(prepared=True)
+		worker.stmt_cursors[sql]=mycursor
+	return mycursor
+
+#####################################
+#
+# getValuesSql(rows)
+#
+# returns the multi-row reading_values INSERT for the given number of rows
+# The strings are kept so each row count is only prepared once
+#
+def getValuesSql(rows):
+	global values_sql
+	sql=values_sql.get(rows)
+	if sql is None:
+		sql="INSERT INTO reading_values (reading_id, value, reading_value_types_id) VALUES "+",".join(["(%s,%s,%s)"]*rows)
+		values_sql[rows]=sql
+	return sql
+
 #
 ######################################
 #
 # decodeJSON
-# returns True/False
+# returns the decoded JSON or None
 def decodeJSON(msg_num,payload):
-	global payloadJson
-	logging.info("process_msg(%s): payload=%s", msg_num, payload)
+	jobLog.info("process_msg(%s): payload=%s", msg_num, payload)
 
 	try:
-		# payload strung was UTF-8 decoded when added to the job queue
-		payloadJson = json.loads(payload)
-		logging.info("decodeJSON(%s): JSON was read ok", msg_num)
-		return True
+		# payload is the MQTT payload bytes, jsonCodec decodes them directly
+		payloadJson = jsonCodec.loads(payload)
+		jobLog.info("decodeJSON(%s): JSON was read ok", msg_num)
+		return payloadJson
 	except Exception as e:
-		logging.exception("decodeJSON(%s): Malformed JSON. message ignored",msg_num)
-		return False
+		rejectLog.exception("decodeJSON(%s): Malformed JSON. message ignored",msg_num)
+		return None
 
 #####################################
-
+#
+# getTypeIds(msg_num)
+#
+# reads reading_value_types and builds a new key_map from it, the type
+# aliases, GNSS_Aliases and IGNORED_KEYS then replaces key_map with it in
+# one assignment so process_job() never sees a half built dictionary
+#
+# key_map[key] is a (type_id,gnss) tuple. type_id is the reading_value_types
+# id the value is stored as, gnss is "latitude", "longitude" or "altitude"
+# for the readings columns. Either can be None, both are for ignored keys.
+# Keys not in key_map are counted by countUnknownKey()
+#
 def getTypeIds(msg_num):
-	global mydb,types_id
-	# first get the device_id from the device_name by looking it up in the database
+	global key_map,typesChecksum
 
 	try:
-		# SQL SELECT to find device_id
 		sql = "SELECT short_descr,id FROM reading_value_types"
 
-
-		# execute SQL to return one record or None
-		mycursor=mydb.cursor()
+		mycursor=worker.mydb.cursor()
 		mycursor.execute(sql)
 		types = mycursor.fetchall()
+
+		new_types_id={}
 		for row in types:
-			types_id[row[0]]=row[1]
+			new_types_id[row[0]]=row[1]
 
 		# add any extra aliases
 		for entry in type_aliases.keys():
-			types_id[entry]=types_id[type_aliases[entry]]
+			if not type_aliases[entry] in new_types_id:
+				logging.error("getTypeIds(%s): alias %s refers to unknown type %s. Ignored.", msg_num, entry, type_aliases[entry])
+				continue
+			new_types_id[entry]=new_types_id[type_aliases[entry]]
+
+		new_key_map={key:(None,None) for key in IGNORED_KEYS}
+		for key,type_id in new_types_id.items():
+			new_key_map[key]=(type_id,None)
+		for key,gnss in GNSS_Aliases.items():
+			new_key_map[key]=(new_key_map.get(key,(None,None))[0],gnss)
+
+		typesChecksum=getTypesChecksum(msg_num)
+		key_map=new_key_map
 
+		logging.info("getTypeIds(%s): loaded %s types and aliases, %s payload keys mapped", msg_num, len(new_types_id), len(key_map))
 		return True
 
-	except mysql.connector.InterfaceError:
-		logging.exception("getTypeId(%s): Unable to connect to database.", msg_num);
+	except mysql.connector.Error:
+		logging.exception("getTypeId(%s): Unable to read reading_value_types.", msg_num);
 		return None
 
+#####################################
+#
+# getTypesChecksum(msg_num)
+#
+# returns the checksum of the reading_value_types table or None
+#
+def getTypesChecksum(msg_num):
+	try:
+		mycursor=worker.mydb.cursor()
+		mycursor.execute("CHECKSUM TABLE reading_value_types")
+		return mycursor.fetchone()[1]
+	except mysql.connector.Error:
+		logging.exception("getTypesChecksum(%s): Unable to get checksum.", msg_num);
+		return None
+
+#####################################
+#
+# getTypeAliases()
+#
+# re-reads reading_value_types_aliases, GNSS_Aliases and ignored_keys
+# from dbLoader.toml, the current ones are kept if the file cannot be read
+#
+def getTypeAliases():
+	global type_aliases,GNSS_Aliases,IGNORED_KEYS
+	try:
+		newConfig=toml.load(configFile)
+		newAliases=newConfig["reading_value_types_aliases"]
+		newGNSS=newConfig["GNSS_Aliases"]
+		newIgnored=newConfig["ignored_keys"]["keys"]
+		type_aliases,GNSS_Aliases,IGNORED_KEYS=newAliases,newGNSS,newIgnored
+		logging.info("getTypeAliases(): aliases reloaded from %s", configFile)
+	except Exception as e:
+		logging.exception("getTypeAliases(): unable to reload aliases from %s. Current aliases kept.", configFile)
+
+#####################################
+#
+# checkTypeIds(msg_num)
+#
+# called from the main loop between batches
+#
+# reloads the aliases and key_map after a SIGHUP, otherwise every
+# TYPES_CHECK_SECS seconds rebuilds key_map if reading_value_types
+# has changed
+#
+def checkTypeIds(msg_num):
+	global reloadTypes,nextTypesCheck
+
+	if reloadTypes:
+		reloadTypes=False
+		logging.info("checkTypeIds(%s): SIGHUP received, reloading types and aliases", msg_num)
+		getTypeAliases()
+		getTypeIds(msg_num)
+	elif TYPES_CHECK_SECS>0:
+		checksum=getTypesChecksum(msg_num)
+		if checksum is not None and checksum!=typesChecksum:
+			logging.info("checkTypeIds(%s): reading_value_types has changed, reloading", msg_num)
+			getTypeIds(msg_num)
+
+	nextTypesCheck=time.time()+TYPES_CHECK_SECS
+
+#####################################
+#
+# on_sighup()
+#
+# signal handler, the reload is done by the main loop
+#
+def on_sighup(signum, frame):
+	global reloadTypes
+	reloadTypes=True
+
 #####################################
 
 def getDeviceId(msg_num):
-	global mydb
-	# first get the device_id from the device_name by looking it up in the database
+	global devices_id,unknown_devices
+	# first get the device_id from the device_name by looking it up in the device registry
 
+	if not 'dev' in worker.payloadJson:
+		jobLog.info("getDeviceId(%s): JSON does not contain a dev key", msg_num)
+		return None
+
+	device_name = worker.payloadJson['dev']
+
+	device_id=devices_id.get(device_name)
+	if device_id is not None:
+		jobLog.info("getDeviceId(%s): device_id=%s", msg_num, device_id)
+		return device_id
+
+	# recently looked up and not registered?
+	with registry_lock:
+		expires=unknown_devices.get(device_name)
+	if expires is not None and expires>time.time():
+		jobLog.info("getDeviceId(%s): device_id not found (cached) name=%s.", msg_num,device_name)
+		return None
+
+	# not seen before, or registered since, so ask the database
 	try:
-		device_name = payloadJson['dev']
 		# SQL SELECT to find device_id
 		sql = "SELECT device_id FROM devices WHERE device_name = %s"
 		vals = (device_name,)
 
 		# execute SQL to return one record or None
-		mycursor=mydb.cursor()
+		mycursor=worker.mydb.cursor()
 		mycursor.execute(sql, vals)
 		rec = mycursor.fetchone()
 
 		# don't go on if the device_name is not known
 		if rec is None:
-			logging.error("getDeviceId(%s): device_id not found  name=%s.", msg_num,device_name)
+			jobLog.info("getDeviceId(%s): device_id not found  name=%s.", msg_num,device_name)
+			addUnknownDevice(device_name)
 			return None
 
 		# get the device_id from the record
 		device_id = rec[0]  # rec is a tuple
-		logging.info("process_msg(%s): device_id=%s", msg_num, str(device_id))
+		devices_id[device_name]=device_id
+		with registry_lock:
+			unknown_devices.pop(device_name,None)
+		jobLog.info("process_msg(%s): device_id=%s", msg_num, device_id)
 		return device_id
 
 	except mysql.connector.InterfaceError:
 		logging.exception("process_msg(%s): Unable to connect to database. Insertion skipped", msg_num);
 		return None
 
+#####################################
+#
+# getDeviceIds(msg_num)
+#
+# loads the device registry (device_name:device_id) from the
+# devices table. Called once at startup, getDeviceId() adds devices
+# registered later
+#
+def getDeviceIds(msg_num):
+	global devices_id
+
+	try:
+		sql = "SELECT device_name,device_id FROM devices"
+
+		mycursor=worker.mydb.cursor()
+		mycursor.execute(sql)
+		for row in mycursor.fetchall():
+			devices_id[row[0]]=row[1]
+
+		logging.info("getDeviceIds(%s): loaded %s devices", msg_num, len(devices_id))
+		return True
+
+	except mysql.connector.InterfaceError:
+		logging.exception("getDeviceIds(%s): Unable to connect to database.", msg_num);
+		return None
+
+#####################################
+#
+# addUnknownDevice(device_name)
+#
+# remember an unregistered device name for UNKNOWN_DEVICE_TTL seconds
+# so a chatty unregistered sensor cannot flood the database with lookups
+#
+# the cache is limited to UNKNOWN_DEVICE_MAX names, expired names are
+# dropped first then the oldest
+#
+def addUnknownDevice(device_name):
+	global unknown_devices
+
+	now=time.time()
+	with registry_lock:
+		if len(unknown_devices)>=UNKNOWN_DEVICE_MAX:
+			for name in [n for n,expires in unknown_devices.items() if expires<=now]:
+				del unknown_devices[name]
+			while len(unknown_devices)>=UNKNOWN_DEVICE_MAX:
+				del unknown_devices[next(iter(unknown_devices))]
+
+		unknown_devices[device_name]=now+UNKNOWN_DEVICE_TTL
+
+#####################################
+#
+# forgetUnknownDevice(payload)
+#
+# payload is a devManager reply {"dev":DEVICE,"status":STATUS,"msg":MESSAGE}
+#
+# when devManager adds a device the name is removed from the unknown
+# device cache so the next message from it is looked up in the database
+# without waiting for the cache entry to expire
+#
+def forgetUnknownDevice(payload):
+	global unknown_devices
+	try:
+		reply=jsonCodec.loads(payload)
+		if reply.get("status") is True:
+			with registry_lock:
+				unknown_devices.pop(reply.get("dev"),None)
+			logging.info("forgetUnknownDevice(): device %s registered by devManager",reply.get("dev"))
+	except Exception as e:
+		rejectLog.exception("forgetUnknownDevice(): Malformed devManager reply ignored")
+
 ########################################
 #
 # getTimeWithTz(timeString)
@@ -237,8 +709,31 @@ def getDeviceId(msg_num):
 # if timeString does not include timezone information
 # adds a UTC timezone
 #
+# the ISO 8601 timestamps the bridges send (TTN received_at with nanoseconds,
+# DEFRA isoformat(), clarity ...000Z, YYYY-MM-DD HH:MM:SS) are picked apart
+# with ISO_TIMESTAMP. Anything else, e.g. "Tue Feb 19 2019 21:16:17 GMT+0000",
+# is left to dateutil
+#
+# returns a datetime or None if timeString can't be understood
+#
+
+ISO_TIMESTAMP=re.compile(r"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,]\d+)?\s*(Z|[+-]\d\d(?::?\d\d)?)?$")
+timezones={None:timezone.utc,"Z":timezone.utc}	# offset:timezone for ISO_TIMESTAMP
 
 def getTimeWithTz(msg_num,timeString):
+	match=ISO_TIMESTAMP.match(timeString) if isinstance(timeString,str) else None
+	if match is not None:
+		try:
+			offset=match.group(7)
+			tz=timezones.get(offset)
+			if tz is None:
+				minutes=int(offset[1:3])*60+(int(offset[-2:]) if len(offset)>3 else 0)
+				tz=timezone(timedelta(minutes=-minutes if offset[0]=="-" else minutes))
+				timezones[offset]=tz
+			return datetime(*map(int,match.group(1,2,3,4,5,6)),tzinfo=tz)
+		except ValueError:
+			pass	# e.g. month 13, let dateutil have a go
+
 	try:
 		d=parse(timeString)
 		if d.tzinfo: return d;
@@ -246,9 +741,25 @@ def getTimeWithTz(msg_num,timeString):
 		return d.replace(tzinfo=pytz.utc)
 
 	except Exception as e:
-		logging.exception("getTimeWithTz(%s) failed. Timestamp will be ignored.",msg_num)
+		rejectLog.error("getTimeWithTz(%s) cannot convert timestamp %s (%s). Timestamp will be ignored.",msg_num,timeString,e)
 		return None
 
+#####################################
+#
+# setBatchTime()
+#
+# works out "now" once for each batch (see writeBatch()) rather than for
+# every message
+#
+# worker.now is the local time labelled as UTC, which is how the future
+# date check has always worked. worker.nowString is the same time in
+# the database format
+#
+def setBatchTime():
+	now=datetime.now().replace(microsecond=0)
+	worker.now=now.replace(tzinfo=timezone.utc)
+	worker.nowString=now.strftime('%Y-%m-%d %H:%M:%S')
+
 #####################################
 #
 # isValidDate(timestamp)
@@ -261,28 +772,23 @@ def getTimeWithTz(msg_num,timeString):
 
 def isValidDate(msg_num,timestamp):
 
-	logging.info("isValidDate(%s): checking timestamp %s",msg_num,timestamp)
+	jobLog.info("isValidDate(%s): checking timestamp %s",msg_num,timestamp)
 
-	try:
-		# get the current time and timestamp in YYYY-MM-DDTHH:MM:SS+nnnn format
-		#
-		now = getTimeWithTz(msg_num,datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z"))
-		ts = getTimeWithTz(msg_num,timestamp)
-
-		# is timestamp in the future?
-		if ts>now:
-			logging.info("isFutureDate(%s) : %s is a future date. Ignored.",msg_num,timestamp)
-			return None
+	ts = getTimeWithTz(msg_num,timestamp)
+	if ts is None:
+		return None
 
-		logging.info("isFutureDate(%s) : %s is a valid date.", msg_num, timestamp)
-		# lose the timezone offset
-		return ts.strftime('%Y-%m-%d %H:%M:%S')
+	# is timestamp in the future?
+	if ts>worker.now:
+		jobLog.info("isFutureDate(%s) : %s is a future date. Ignored.",msg_num,timestamp)
+		return None
 
-	except ValueError:
+	# for the ingest lag, see recordLags()
+	worker.recordedOnTime=ts.timestamp()
 
-		logging.info("isFutureDate(%s) : Cannot convert timestamp. Check the format is YYYY-MM-DDThh:mm:ss+nnnn. "
-					 "Ignored", msg_num, timestamp)
-		return None
+	jobLog.info("isFutureDate(%s) : %s is a valid date.", msg_num, timestamp)
+	# lose the timezone offset
+	return "%04d-%02d-%02d %02d:%02d:%02d" % (ts.year,ts.month,ts.day,ts.hour,ts.minute,ts.second)
 
 
 #
@@ -292,131 +798,214 @@ def isValidDate(msg_num,timestamp):
 # to simplify the SQL required
 #
 def getRecordedOn(msg_num):
-	global payloadJson
+	worker.recordedOnTime=None
 
-	if not 'timestamp' in payloadJson:
-		logging.info("getRecordedOn(%s): JSON does not contain a timestamp",msg_num)
+	if not 'timestamp' in worker.payloadJson:
+		jobLog.info("getRecordedOn(%s): JSON does not contain a timestamp",msg_num)
 		return  None
 
-	dateTimeString = payloadJson['timestamp']
-	logging.info("getRecordedOn(%s): JSON includes a timestamp %s", msg_num, str(dateTimeString))
+	dateTimeString = worker.payloadJson['timestamp']
+	jobLog.info("getRecordedOn(%s): JSON includes a timestamp %s", msg_num, dateTimeString)
 
 	try:
 		# recordedONString is a string in the required database format
 		recordedOnString = isValidDate(msg_num,dateTimeString)
-		logging.info("getRecordedOn(%s): recordedOnString=%s", msg_num, recordedOnString)
+		jobLog.info("getRecordedOn(%s): recordedOnString=%s", msg_num, recordedOnString)
 		return recordedOnString
 	except ValueError:
-		logging.exception("process_msg(%s): cannot convert timestamp to datetime object", str(msg_num))
+		rejectLog.exception("process_msg(%s): cannot convert timestamp to datetime object", msg_num)
 		return None
 
 ######################################
 #
-# addReadingValues()
+# addReadingValues(msg_num,reading_id,values)
+#
+# add the data values found by mapPayload() to the reading_values table
+# with one multi-row INSERT, see getValuesSql()
+#
+# values is a list of (value,type_id)
+#
+# returns True/False, the caller commits or rolls back
 #
-# add allowed data values to the reading_values table
+def addReadingValues(msg_num,reading_id,values):
 
-def addReadingValues(msg_num,reading_id):
-	global payloadJson,types_id
+	if len(values)==0:
+		jobLog.info("addReadingValues(%s): no data values to add", msg_num)
+		return True
 
-	logging.info("addReadingValues(%s): trying to add records to reading_values for reading_id=%s", msg_num,
-				 str(reading_id))
+	jobLog.info("addReadingValues(%s): adding %s rows for reading_id=%s values=%s", msg_num, len(values), reading_id, values)
 
-	# next insert each parameter's reading into reading_values
-	sql = "INSERT INTO reading_values (reading_id, value, reading_value_types_id) VALUES (%s, %s, %s)"
+	params=[]
+	for value,type_id in values:
+		params+=(reading_id,value,type_id)
 
-	# process the JSON string
 	try:
-		for key, value in payloadJson.items():
-
-			logging.info("addReadingValues(%s): trying to add record to reading_values for key=%s", msg_num, str(key))
-			if not key in types_id:
-				logging.info("addReadingValues(%s): Ignoring non-data value key %s found in JSON", msg_num, str(key))
-				continue
+		sql=getValuesSql(len(values))
+		getCursor(sql).execute(sql, params)
 
-			logging.info("addReadingValues(%s): processing data value key %s", msg_num, str(key))
-
-			# get the type id from the dictionary
-			type_id = types_id[key]
-			logging.info("addReadingValues(%s): got reading_value_types_id %s", msg_num, str(type_id))
+	except Exception as e:
+		rejectLog.exception("addReadingValues(%s): error adding reading_values", msg_num)
+		return False
 
-			# add the new value
-			vals = (reading_id, value, type_id)
+	jobLog.info("addReadingValues(%s): finished adding to reading_values", msg_num)
+	return True
 
-			if dbUpdate(msg_num,sql, vals) is None:
-				logging.error("addReadingValues(%s): failed to insert new record for %s into reading_values table", msg_num,
-							  str(key))
+#####################################
+#
+# mapPayload(msg_num)
+#
+# looks up each payload key once in key_map, see getTypeIds()
+#
+# returns (values,(lat,lon,alt)). values is a list of (value,type_id)
+# for addReadingValues(). Values which are not numbers are counted in
+# bad_values and left out, reading_values.value is a double so one bad
+# value would fail the whole multi-row INSERT and lose the reading.
+# lat,lon,alt are strings which can be passed to the SQL commands, NULL (None) is used for all three unless all
+# three are present so that complex SQL selection is not needed
+#
+def mapPayload(msg_num):
+	keyMap=key_map		# getTypeIds() may replace key_map
+	values=[]
+	gnss={}
+
+	for key,value in worker.payloadJson.items():
+		entry=keyMap.get(key)
+		if entry is None:
+			countUnknownKey(key)
+			continue
+		type_id,field=entry
+		if type_id is not None:
+			if isNumeric(value):
+				values.append((value,type_id))
 			else:
-				logging.info("addReadingValues(%s): finished adding data value for key %s", msg_num, str(key))
+				jobLog.info("mapPayload(%s): %s=%r is not a number. Ignored.",msg_num,key,value)
+				with counts_lock:
+					bad_values[key]+=1
+		if field is not None:
+			gnss[field]=str(value)
 
-	except Exception as e:
-		logging.exception("addReadingValues(%s): error adding reading_values", msg_num)
-		return
+	if len(gnss)<3:
+		jobLog.info("mapPayload(%s): Incomplete GNSS data or none. Ignored.",msg_num)
+		return values,(None,None,None)
 
-	logging.info("addReadingValues(%s): finished adding to reading_values", msg_num)
+	jobLog.info("mapPayload(%s): Full GNSS data is included", msg_num)
+	return values,(gnss["latitude"],gnss["longitude"],gnss["altitude"])
 
 #####################################
 #
-# getLatLonAlt()
+# isNumeric(value)
 #
-# returns tuple (lat,lon,alt) as strings which can be passed to
-# the SQL commands NULL is used so that complesx SQL selection is not needed
+# True for a finite int or float, or a string which is one (sensors
+# send "22.5"). None, other strings, lists and objects are not
 #
-def getLatLonAlt(msg_num):
-	global GNSS_Aliases
+def isNumeric(value):
+	if isinstance(value,str):
+		try:
+			value=float(value)
+		except ValueError:
+			return False
+	return isinstance(value,(int,float)) and math.isfinite(value)
 
-	latitude=None
-	longitude=None
-	altitude=None
+#####################################
+#
+# countUnknownKey(key)
+#
+# payload keys which are not reading types, GNSS aliases or ignored_keys
+# are counted and logged by logStats() rather than for every message.
+# Once UNKNOWN_KEYS_MAX different keys have been seen the rest are
+# counted together
+#
+def countUnknownKey(key):
+	with counts_lock:
+		if key not in unknown_keys and len(unknown_keys)>=UNKNOWN_KEYS_MAX:
+			key="(others)"
+		unknown_keys[key]+=1
 
-	for k in GNSS_Aliases.keys():
-		if k in payloadJson:
-			if GNSS_Aliases[k]=="longitude":
-				longitude=str(payloadJson[k])
-			elif GNSS_Aliases[k]=="latitude":
-				latitude=str(payloadJson[k])
-			elif GNSS_Aliases[k]=="altitude":
-				altitude=str(payloadJson[k])
+#####################################
+#
+# countRejected(reason)
+#
+# counts a message which is not written in rejected_counts, for
+# logStats(), and dbloader_rejected_total
+#
+def countRejected(reason):
+	REJECTED.inc(reason)
+	with counts_lock:
+		rejected_counts[reason]+=1
 
-	if latitude is None or longitude is None or altitude is None:
-		logging.info("getLatLonAlt(%s): Incomplete GNSS data or none. Ignored.",msg_num)
-		return (None,None,None)
-	else:
-		logging.info("getLatLonAlt(%s): Full GNSS data is included", msg_num)
-		return(latitude,longitude,altitude)
+#####################################
+#
+# copyCounts(counts)
+#
+# a copy of rejected_counts, duplicate_counts, unknown_keys or bad_values
+# taken under counts_lock, they can't be iterated while a worker adds a key
+#
+def copyCounts(counts):
+	with counts_lock:
+		return collections.Counter(counts)
 
 #####################################
 #
-# updateLastSeen(device_id,readings_id)
+# updateLastSeen(msg_num,device_id,lastSeen)
+#
+# the lastseen column in devices table speeds up the API interface
 #
-# updates the lastseen column in devices table
-# to speed up API interface
+# devices.last_seen is not updated for every message. lastSeen is the
+# readings s_or_r value worked out locally (recordedon, or now if there
+# is no timestamp) so it does not need to be read back. The latest value
+# for each device is kept in batch_last_seen until the batch commits
+# then moved to pending_last_seen for flushLastSeen()
 #
 #####################################
 
-def updateLastSeen(msg_num,device_id,readings_id):
-	global mydb
-	logging.info("updateLastSeen(%s) device_id=%s,readings_id=%s",msg_num,device_id,readings_id)
-	# read back from the database
-	SQL="select max(s_or_r) from readings where id=%s"
-	mycursor=mydb.cursor()
-	mycursor.execute(SQL,[readings_id])
-	r=mycursor.fetchone()
-	if r is None:
-		logging.error("updateLastSeen(%s): unable to get last seen for readings.id=%s", msg_num,readings_id)
-		return
+def updateLastSeen(msg_num,device_id,lastSeen):
+	jobLog.info("updateLastSeen(%s) device_id=%s,lastSeen=%s",msg_num,device_id,lastSeen)
+
+	# timestamps are 'YYYY-MM-DD HH:MM:SS' strings which sort correctly
+	if not device_id in worker.batch_last_seen or lastSeen>worker.batch_last_seen[device_id]:
+		worker.batch_last_seen[device_id]=lastSeen
+
+#####################################
+#
+# flushLastSeen(msg_num)
+#
+# writes one update per device for all committed readings since
+# the last flush. Called from the main loop every LAST_SEEN_SECS
+#
+# returns True/False, on failure the values are kept for the next flush
+#
+def flushLastSeen(msg_num):
+	global pending_last_seen,nextLastSeenFlush
+
+	nextLastSeenFlush=time.time()+LAST_SEEN_SECS
+
+	with last_seen_lock:
+		if len(pending_last_seen)==0:
+			return True
 
+		flushing=pending_last_seen
+		pending_last_seen={}
+
+	logging.info("flushLastSeen(%s): updating last_seen for %s devices",msg_num,len(flushing))
 	try:
-		lastSeen=None
-		# update the devices table
-		lastSeen=r[0]
-		logging.info("updateLastSeen(%s): lastseen=%s",msg_num,lastSeen)
-		SQL="update devices set last_seen=%s, visible=1 where device_id=%s"
-		mycursor.execute(SQL,[lastSeen,device_id])
-		mydb.commit()
-		logging.info("updateLastSeen(%s): completed normally",msg_num)
+		start=time.perf_counter()
+		getCursor(LAST_SEEN_SQL).executemany(LAST_SEEN_SQL,[(lastSeen,device_id) for device_id,lastSeen in flushing.items()])
+		worker.mydb.commit()
+		STAGE_SECONDS.observe("last_seen",time.perf_counter()-start)
+		return True
+
 	except Exception as e:
-		logging.exception("updateLastSeen(%s): %s",msg_num,e)
+		logging.exception("flushLastSeen(%s): %s",msg_num,e)
+		try:
+			worker.mydb.rollback()
+		except Exception as e:
+			logging.exception("flushLastSeen(%s): rollback failed",msg_num)
+		# keep them for next time unless something newer has arrived
+		with last_seen_lock:
+			for device_id,lastSeen in flushing.items():
+				if not device_id in pending_last_seen or lastSeen>pending_last_seen[device_id]:
+					pending_last_seen[device_id]=lastSeen
+		return False
 
 #####################################
 #
@@ -424,51 +1013,513 @@ def updateLastSeen(msg_num,device_id,readings_id):
 #
 # main flow analysing the payload and acting on it
 #
-# This is called from the main loop when it finds a job
-# to do
+# This is called by writeBatch() for each job in a batch. Rows are
+# written but not committed, writeBatch() does that for the whole batch
+#
+# payloadJson is the payload decoded by dispatchJob()
+#
+# returns JOB_WRITTEN, JOB_SKIPPED or JOB_FAILED
 #
-def process_job(msg_num, payload):
-	global debug,mydb, payloadJson
+def process_job(msg_num, payload, payloadJson):
+	global debug
 
 	if debug:
-		logging.debug(f"process_job({msg_num}) payload={payload}")
-		return
+		jobLog.debug("process_job(%s) payload=%s",msg_num,payload)
+		return JOB_SKIPPED
 
-	logging.info("-"*40)	# visual separator for the log file
-	if not decodeJSON(msg_num,payload):
-		return
+	jobLog.info("-"*40)	# visual separator for the log file
+	worker.payloadJson=payloadJson
 
 	# check device id is valid
+	start=time.perf_counter()
 	device_id=getDeviceId(msg_num)
+	STAGE_SECONDS.observe("device_lookup",time.perf_counter()-start)
 	if device_id is None:
-		logging.error(f"process_job({msg_num}): Unresolved device_id. Payload skipped")
-		return
+		# per message and rate limited, the totals are logged by logStats()
+		jobLog.info("process_job(%s): Unresolved device_id. Payload skipped",msg_num)
+		countRejected("unknown_device" if "dev" in payloadJson else "no_dev")
+		return JOB_SKIPPED
 
-	# GNNS data? if not (None,None,None) is returned for each
-	(lat,lon,alt)=getLatLonAlt(msg_num)
+	# reading values and GNSS data, (None,None,None) if there is no GNSS data
+	start=time.perf_counter()
+	values,(lat,lon,alt)=mapPayload(msg_num)
+	STAGE_SECONDS.observe("map_payload",time.perf_counter()-start)
 
 	# timestamp provided? if not None is returned
+	start=time.perf_counter()
 	recordedOn=getRecordedOn(msg_num)
+	STAGE_SECONDS.observe("timestamp",time.perf_counter()-start)
 
-	sql = "INSERT INTO readings (storedon,recordedon,device_id,raw_json,reading_latitude,reading_longitude," \
-		  "reading_altitude) values (now(),%s,%s,%s,%s,%s,%s)"
+	# seen it already?
+	if isDuplicate(device_id,recordedOn):
+		jobLog.info("process_job(%s): duplicate reading for device_id %s recordedon %s skipped",msg_num,device_id,recordedOn)
+		with counts_lock:
+			duplicate_counts["memory"]+=1
+		return JOB_SKIPPED
 
-	vals = (recordedOn,device_id, str(payloadJson),lat,lon,alt	)
+	vals = (recordedOn,device_id, getRawJson(payload),lat,lon,alt	)
 
-	readings_id=dbUpdate(msg_num,sql, vals)
+	# the readings row and its reading_values are committed by writeBatch()
+	start=time.perf_counter()
+	readings_id=dbUpdate(msg_num,READINGS_SQL, vals)
+	STAGE_SECONDS.observe("readings_insert",time.perf_counter()-start)
 
 	if readings_id is None:
-		logging.error("process_job(%s) insert record into readings table failed.",msg_num)
+		rejectLog.error("process_job(%s) insert record into readings table failed.",msg_num)
+		return JOB_FAILED
+
+	# 0 if the device already has a reading recorded then
+	if readings_id==0:
+		jobLog.info("process_job(%s): duplicate reading for device_id %s recordedon %s skipped",msg_num,device_id,recordedOn)
+		with counts_lock:
+			duplicate_counts["database"]+=1
+		return JOB_SKIPPED
+
+	if recordedOn is not None:
+		worker.batch_keys.add((device_id,recordedOn))
+
+	jobLog.info("process_job(%s): readings_id=%s",msg_num,readings_id)
+	jobLog.info("process_job(%s): parameters=%s",msg_num,worker.payloadJson)
+
+	start=time.perf_counter()
+	ok=addReadingValues(msg_num,readings_id,values)
+	STAGE_SECONDS.observe("values_insert",time.perf_counter()-start)
+	if not ok:
+		return JOB_FAILED
+
+	# s_or_r for this reading, devices.last_seen is updated later
+	if recordedOn is not None:
+		updateLastSeen(msg_num,device_id,recordedOn)
+		worker.batch_lags.append((payloadJson["dev"],worker.recordedOnTime))
+	else:
+		updateLastSeen(msg_num,device_id,worker.nowString)
+
+	jobLog.info("process_job(%s): finished normally",msg_num)
+	return JOB_WRITTEN
+
+#####################################
+#
+# getRawJson(payload)
+#
+# returns what is stored in readings.raw_json, valid JSON which any
+# JSON parser can read
+#
+# RAW_JSON="original" - the payload exactly as received
+# RAW_JSON="compact"  - the decoded JSON re-serialised without spaces
+#
+# if RAW_JSON_COMPRESS>0 anything that long or longer is zlib compressed
+# and stored as "zlib:" followed by base64, if that makes it shorter
+#
+# payload is bytes, it has already been decoded as JSON so it is valid UTF-8
+#
+def getRawJson(payload):
+	if RAW_JSON=="compact":
+		payload=jsonCodec.dumps(worker.payloadJson)
+	else:
+		payload=payload.decode("UTF-8")
+
+	if RAW_JSON_COMPRESS>0 and len(payload)>=RAW_JSON_COMPRESS:
+		compressed="zlib:"+base64.b64encode(zlib.compress(payload.encode("UTF-8"))).decode("ascii")
+		if len(compressed)<len(payload):
+			return compressed
+
+	return payload
+
+#####################################
+#
+# isDuplicate(device_id,recordedOn)
+#
+# returns True if this device has a reading recorded at the same time
+# in the batch being written or in its last DEDUP_WINDOW committed
+# readings. Anything older is caught by the unique key on readings
+# (device_id,recordedon) but only after a database round trip
+#
+# readings without a timestamp are never duplicates
+#
+# all the messages from a device go to the same worker, see dispatchJob(),
+# so each worker keeps its own recent_readings
+#
+def isDuplicate(device_id,recordedOn):
+	if recordedOn is None:
+		return False
+	if (device_id,recordedOn) in worker.batch_keys:
+		return True
+	recent=worker.recent_readings.get(device_id)
+	return recent is not None and recordedOn in recent
+
+#####################################
+#
+# rememberReading(device_id,recordedOn)
+#
+# adds a committed reading to the device's recent_readings, the
+# oldest is forgotten when there are more than DEDUP_WINDOW
+#
+def rememberReading(device_id,recordedOn):
+	if DEDUP_WINDOW<=0:
+		return
+	recent=worker.recent_readings.get(device_id)
+	if recent is None:
+		recent=collections.OrderedDict()
+		worker.recent_readings[device_id]=recent
+	recent[recordedOn]=True
+	if len(recent)>DEDUP_WINDOW:
+		recent.popitem(last=False)
+
+#####################################
+#
+# getSource(device_name)
+#
+# returns the bridge a device's readings come from, worked out from the
+# device name prefix in [lag.sources] e.g. "CL-" is a Clarity sensor
+#
+def getSource(device_name):
+	source=device_sources.get(device_name)
+	if source is None:
+		source=LAG_DEFAULT_SOURCE
+		for prefix,name in LAG_SOURCES:
+			if device_name.startswith(prefix):
+				source=name
+				break
+		device_sources[device_name]=source
+	return source
+
+#####################################
+#
+# recordLags(lags)
+#
+# lags is a list of (device name,recordedon as a unix time) for the
+# readings just committed. The ingest lag, how long after it was
+# recorded the reading reached the database, is added to the device's
+# last LAG_DEVICE_WINDOW lags and its source's last LAG_SOURCE_WINDOW
+#
+def recordLags(lags):
+	if len(lags)==0:
+		return
+	now=time.time()
+	with lag_lock:
+		for device_name,recordedOnTime in lags:
+			lag=now-recordedOnTime
+			recent=device_lags.get(device_name)
+			if recent is None:
+				recent=collections.deque(maxlen=LAG_DEVICE_WINDOW)
+				device_lags[device_name]=recent
+			recent.append(lag)
+
+			source=getSource(device_name)
+			recent=source_lags.get(source)
+			if recent is None:
+				recent=collections.deque(maxlen=LAG_SOURCE_WINDOW)
+				source_lags[source]=recent
+			recent.append(lag)
+
+#####################################
+#
+# lagQuantiles(lags)
+#
+# lags is device_lags or source_lags. Returns a dictionary of
+# name:{quantile:lag} for each of LAG_QUANTILES plus "max"
+#
+def lagQuantiles(lags):
+	with lag_lock:
+		recent={name:sorted(values) for name,values in lags.items()}
+	summary={}
+	for name,values in recent.items():
+		summary[name]={q:values[min(len(values)-1,int(q*len(values)))] for q in LAG_QUANTILES}
+		summary[name]["max"]=values[-1]
+	return summary
+
+#####################################
+#
+# lagMetrics(lags)
+#
+# the quantiles for metrics.Gauge, (name,quantile):lag
+#
+def lagMetrics(lags):
+	return {(name,q):lag for name,quantiles in lagQuantiles(lags).items() for q,lag in quantiles.items()}
+
+#####################################
+#
+# lagWarning()
+#
+# returns source:1 for sources whose 90th percentile lag is over
+# LAG_WARN_SECS, source:0 for the rest. If every source is lagging
+# dbLoader (or the database) is probably falling behind, if only one
+# is that bridge or its sensors are late
+#
+def lagWarning():
+	return {source:int(quantiles[0.9]>LAG_WARN_SECS) for source,quantiles in lagQuantiles(source_lags).items()}
+
+#####################################
+#
+# commitJob(msg_num)
+#
+# commit (or roll back) whatever has been written since the last commit
+# returns True/False
+#
+def commitJob(msg_num):
+	global pending_last_seen
+	start=time.perf_counter()
+	try:
+		worker.mydb.commit()
+	except Exception as e:
+		logging.exception("commitJob(%s): commit failed",msg_num)
+		rollbackJob(msg_num)
+		return False
+	STAGE_SECONDS.observe("commit",time.perf_counter()-start)
+
+	# the readings are in the database so devices.last_seen can follow
+	with last_seen_lock:
+		for device_id,lastSeen in worker.batch_last_seen.items():
+			if not device_id in pending_last_seen or lastSeen>pending_last_seen[device_id]:
+				pending_last_seen[device_id]=lastSeen
+	worker.batch_last_seen={}
+
+	# and isDuplicate() can spot them being sent again
+	for device_id,recordedOn in worker.batch_keys:
+		rememberReading(device_id,recordedOn)
+	worker.batch_keys=set()
+
+	recordLags(worker.batch_lags)
+	worker.batch_lags=[]
+	return True
+
+#####################################
+#
+# rollbackJob(msg_num)
+#
+# discard whatever has been written since the last commit
+#
+def rollbackJob(msg_num):
+	worker.batch_last_seen={}
+	worker.batch_keys=set()
+	worker.batch_lags=[]
+	try:
+		worker.mydb.rollback()
+	except Exception as e:
+		logging.exception("rollbackJob(%s): rollback failed",msg_num)
+
+#####################################
+#
+# writeBatch(batch)
+#
+# batch is a list of (msg_num,payload,payloadJson,done) tuples collected by getBatch()
+#
+# every job is written then the whole batch is committed once (group commit)
+# If any database write fails the batch is rolled back and the jobs are
+# written again one at a time, each with its own commit, so one bad
+# message cannot lose the rest of the batch
+#
+# raises mysql.connector.errors.InterfaceError if the database connection
+# was lost, see dbWorker()
+#
+def writeBatch(batch):
+
+	logging.info("writeBatch(): writing %s jobs",len(batch))
+	setBatchTime()
+
+	failed=False
+	written=0
+	for msg_num,payload,payloadJson,done in batch:
+		result=process_job(msg_num,payload,payloadJson)
+		if result==JOB_FAILED:
+			failed=True
+			break
+		if result==JOB_WRITTEN:
+			written+=1
+
+	if not failed and commitJob(batch[-1][0]):
+		logging.info("writeBatch(): committed %s jobs",len(batch))
+		WRITTEN.mark(written)
 		return
 
-	logging.info("process_job(%s): readings_id=%s",msg_num,str(readings_id))
-	logging.info("process_job(%s): parameters=%s",msg_num,str(payloadJson))
+	rollbackJob(batch[-1][0])
+	if not worker.mydb.is_connected():
+		raise mysql.connector.errors.InterfaceError("database connection lost")
 
-	addReadingValues(msg_num,readings_id)
+	if len(batch)==1:
+		rejectLog.error("writeBatch(%s): job rolled back.",batch[0][0])
+		countRejected("failed")
+		return
+
+	logging.error("writeBatch(): batch rolled back, retrying %s jobs one at a time",len(batch))
+	for msg_num,payload,payloadJson,done in batch:
+		result=process_job(msg_num,payload,payloadJson)
+		if result==JOB_WRITTEN:
+			if commitJob(msg_num):
+				WRITTEN.mark()
+			else:
+				countRejected("failed")
+		else:
+			rejectLog.error("writeBatch(%s): job rolled back.",msg_num)
+			if result==JOB_FAILED:
+				countRejected("failed")
+			rollbackJob(msg_num)
+
+#####################################
+#
+# getBatch(work_queue)
+#
+# waits for a job on work_queue then collects more until BATCH_SIZE jobs
+# have been collected or BATCH_MS milliseconds have passed since the
+# first one, whichever comes first
+#
+# returns a list of (msg_num,payload,payloadJson,done) tuples
+#
+def getBatch(work_queue):
+
+	batch=[work_queue.get()]
+	deadline=time.time()+BATCH_MS/1000.0
+	while len(batch)<BATCH_SIZE:
+		remaining=deadline-time.time()
+		if remaining<=0:
+			break
+		try:
+			batch.append(work_queue.get(timeout=remaining))
+		except queue.Empty:
+			break
+
+	return batch
+
+#####################################
+#
+# dispatchJob(payload,done=None)
+#
+# called by the main loop for each job on the job_queue or from the spool
+#
+# decodes the JSON and hands the job to a worker. The worker is chosen
+# from the device name so all the messages from a device are written
+# by the same worker, in the order received
+#
+# done is called once the job has been dealt with, written or not
+#
+def dispatchJob(payload,done=None):
+	global message_number
+
+	msg_num=message_number
+	# bump the message number with wrap around
+	message_number=(message_number+1) % MAX_MESSAGE_NUMBER
+
+	start=time.perf_counter()
+	payloadJson=decodeJSON(msg_num,payload)
+	STAGE_SECONDS.observe("decode",time.perf_counter()-start)
+	if payloadJson is None:
+		countRejected("bad_json")
+		jobDone(done)
+		return
+
+	if not isinstance(payloadJson,dict):
+		rejectLog.error("dispatchJob(%s): JSON is not an object. message ignored",msg_num)
+		countRejected("not_object")
+		jobDone(done)
+		return
+
+	worker_num=hash(str(payloadJson.get("dev"))) % WORKERS
+	worker_queues[worker_num].put((msg_num,payload,payloadJson,done))
+
+def jobDone(done):
+	if done is not None:
+		done()
+
+#####################################
+#
+# dispatchSpooled()
+#
+# hands up to BATCH_SIZE jobs from the spool to the workers
+#
+def dispatchSpooled():
+	for seq,payload in mySpool.read(BATCH_SIZE):
+		dispatchJob(payload,functools.partial(mySpool.done,seq))
+
+#####################################
+#
+# maintainSpool()
+#
+# called by the main loop, saves the checkpoint every SPOOL_CHECKPOINT_MS
+# and forces the spool to disk every SPOOL_FSYNC_MS (0=never)
+#
+def maintainSpool():
+	global nextSpoolCheckpoint,nextSpoolSync
+	now=time.time()
+	try:
+		if now>=nextSpoolCheckpoint:
+			nextSpoolCheckpoint=now+SPOOL_CHECKPOINT_MS/1000
+			mySpool.saveCheckpoint()
+		if SPOOL_FSYNC_MS>0 and now>=nextSpoolSync:
+			nextSpoolSync=now+SPOOL_FSYNC_MS/1000
+			mySpool.sync()
+	except OSError as e:
+		logging.error("maintainSpool(): %s",e)
+
+#####################################
+#
+# mainLoopTimeout()
+#
+# how long the main loop can wait for a job before it has something
+# else to do (reading_value_types check, devices.last_seen flush or
+# logStats())
+# never more than 1s so a SIGHUP is acted on promptly
+#
+def mainLoopTimeout():
+	now=time.time()
+	timeout=min(1.0,nextStatsLog-now)
+	if TYPES_CHECK_SECS>0:
+		timeout=min(timeout,nextTypesCheck-now)
+	if len(pending_last_seen)>0:
+		timeout=min(timeout,nextLastSeenFlush-now)
+	if mySpool is not None:
+		timeout=min(timeout,nextSpoolCheckpoint-now)
+		if SPOOL_FSYNC_MS>0:
+			timeout=min(timeout,nextSpoolSync-now)
+	return max(timeout,0.001)
 
-	updateLastSeen(msg_num,device_id,readings_id)
+#####################################
+#
+# dbWorker(worker_num)
+#
+# worker thread, writes batches of jobs from its worker_queue using
+# its own connection from the pool
+#
+# a batch which fails with an unexpected error is rolled back and its
+# jobs are not done, nothing is acknowledged and the spool checkpoint
+# doesn't pass them, so they are loaded again when the broker redelivers
+# (persistent session) or dbLoader restarts (spool)
+#
+def dbWorker(worker_num):
+	worker.mydb=dbPool.get_connection()
+	worker.stmt_cursors={}
+	worker.stmt_connection_id=None
+	worker.batch_last_seen={}
+	worker.batch_keys=set()
+	worker.batch_lags=[]
+	worker.recent_readings={}
+	worker.payloadJson=None
+
+	logging.info("dbWorker(%s): started",worker_num)
+
+	while True:
+		batch=getBatch(worker_queues[worker_num])
+		while True:
+			try:
+				# make sure the dabase is alive and well
+				worker.mydb.ping(reconnect=True, attempts=5, delay=1)
+				writeBatch(batch)
+			except (mysql.connector.errors.InterfaceError,mysql.connector.errors.OperationalError) as e:
+				# keep the batch till the database comes back, the
+				# job_queue fills up meanwhile (see queueJob()) or
+				# messages wait in the spool
+				logging.error("dbWorker(%s): database unavailable, retrying in 5s. %s",worker_num,e)
+				time.sleep(5)
+				continue
+			except Exception as e:
+				logging.exception("dbWorker(%s): batch abandoned",worker_num)
+				rollbackJob(batch[0][0])
+				for job in batch:
+					countRejected("failed")
+				break
 
-	logging.info("process_job(%s): finished normally",msg_num)
+			for job in batch:
+				jobDone(job[3])
+			break
 
 #####################################
 #
@@ -479,25 +1530,291 @@ def on_connect(mqttc, obj, flags, rc):
 
 	if rc==0:
 		brokerConnected=True
-		logging.info("on_connect(): callback ok, subscribing to Topic: %s",mqttTopic)
-		mqttc.subscribe(mqttTopic, 0)
+		newAckConnection()
+		logging.info("on_connect(): callback ok, subscribing to Topic: %s QoS %s",subscribeTopic,MQTT_QOS)
+		mqttc.subscribe(subscribeTopic, MQTT_QOS)
+		# devManager replies tell us when a new device has been added
+		mqttc.subscribe(devMgrReplyTopic, 0)
 	else:
 		brokerConnected=False
 		logging.info("on_connect(): callback error rc=%s",str(rc))
+	connectEvent.set()	# wake waitForConnect()
 
 def on_disconnect(client, userdata, rc):
    global brokerConnected
    brokerConnected = False
+   # wake the main loop so it notices straight away
+   try:
+      job_queue.put_nowait(None)
+   except queue.Full:
+      pass	# the main loop is busy and will see brokerConnected soon
+
+################################
+#
+# newAckConnection()
+#
+# called by on_connect(). Messages which were not acknowledged on the last
+# connection are sent again by the broker so their acks are dropped
+#
+def newAckConnection():
+	global ackReceived,ackNext,ackConnection
+	with ack_lock:
+		ackConnection+=1
+		ackReceived=0
+		ackNext=0
+		ack_ready.clear()
+
+################################
+#
+# ackJob(connection,received,mid)
+#
+# the message has been committed (or spooled or dropped) so the
+# broker can forget it. received is its place in the order received,
+# MQTT expects PUBACKs in that order so a message finished early
+# waits in ack_ready
+#
+def ackJob(connection,received,mid):
+	global ackNext
+	with ack_lock:
+		if connection!=ackConnection:
+			return
+		ack_ready[received]=mid
+		while ackNext in ack_ready:
+			mqttc.ack(ack_ready.pop(ackNext),1)
+			ackNext+=1
 
 ################################
 #
 # on_message() MQTT broker callback
 #
-# UTF-8 decode the payload and add it to the job queue see main()
+# add the payload bytes to the job queue see main(), they are decoded by
+# dispatchJob()
+#
+# devManager replies are handled here, they are not jobs
+#
+# with a PERSISTENT_SESSION QoS 1 messages are acknowledged once the job
+# is done (see dbWorker()) or straight away if they have been spooled
 #
 def on_message(mqttc, obj, msg):
-	logging.info("on_message() received payload=%s",msg.payload)
-	job_queue.put(msg.payload.decode("UTF-8"))
+	global ackReceived
+	jobLog.info("on_message() received payload=%s",msg.payload)
+	if msg.topic==devMgrReplyTopic:
+		forgetUnknownDevice(msg.payload)
+		return
+	RECEIVED.mark()
+
+	done=None
+	if PERSISTENT_SESSION and msg.qos>0:
+		done=functools.partial(ackJob,ackConnection,ackReceived,msg.mid)
+		ackReceived+=1
+
+	if mySpool is not None:
+		try:
+			mySpool.append(msg.payload)
+		except OSError as e:
+			logging.error("on_message(): unable to write to the spool, message queued. %s",e)
+			queueJob(msg.payload,done)
+			return
+		jobDone(done)
+		# wake the main loop
+		try:
+			job_queue.put_nowait(None)
+		except queue.Full:
+			pass
+		return
+	queueJob(msg.payload,done)
+
+#####################################
+#
+# queueJob(payload,done=None)
+#
+# called from on_message() which runs on paho's network thread.
+# Blocking here stalls keepalives and the broker drops us so when
+# the job_queue is full OVERFLOW_POLICY decides what happens
+#
+# block       - wait up to OVERFLOW_BLOCK_MS then drop the message
+# drop_oldest - throw away the oldest queued job to make room
+# drop_newest - throw away this message
+# spill       - append to SPILL_FILE, read back by the main loop
+#
+# overflow_counts records what happened
+#
+# done is called when the job is dispatched or, if it is spilled,
+# before returning. A dropped message is never acknowledged so with a
+# PERSISTENT_SESSION (only block or spill allowed) block waits for as
+# long as it takes and a failed spill is queued anyway. If keepalives
+# stall meanwhile the broker redelivers whatever wasn't acknowledged
+#
+def queueJob(payload,done=None):
+	# keep the order while the spill file is being drained
+	if spillPending>0 and spillJob(payload):
+		jobDone(done)
+		return
+
+	try:
+		job_queue.put_nowait((payload,done))
+		return
+	except queue.Full:
+		overflow_counts["full"]+=1
+
+	if OVERFLOW_POLICY=="block":
+		try:
+			job_queue.put((payload,done),timeout=None if PERSISTENT_SESSION else OVERFLOW_BLOCK_MS/1000)
+			return
+		except queue.Full:
+			overflow_counts["block_timeouts"]+=1
+			overflow_counts["dropped_newest"]+=1
+			logging.error("job_queue full for %sms, message dropped",OVERFLOW_BLOCK_MS)
+
+	elif OVERFLOW_POLICY=="drop_oldest":
+		while True:
+			try:
+				oldest=job_queue.get_nowait()
+				if oldest is not None:
+					overflow_counts["dropped_oldest"]+=1
+			except queue.Empty:
+				pass
+			try:
+				job_queue.put_nowait((payload,done))
+				return
+			except queue.Full:
+				continue
+
+	elif OVERFLOW_POLICY=="drop_newest":
+		overflow_counts["dropped_newest"]+=1
+
+	elif spillJob(payload):
+		jobDone(done)
+
+	elif PERSISTENT_SESSION:
+		job_queue.put((payload,done))
+
+#####################################
+#
+# spillJob(payload)
+#
+# appends the payload to SPILL_FILE as a length line followed by the
+# payload bytes (payloads can contain newlines)
+#
+# if the spill file can't be written the message is dropped
+#
+# returns True if the payload was written
+#
+def spillJob(payload):
+	global spillFile,spillPending
+	with spill_lock:
+		try:
+			if spillFile is None:
+				spillFile=open(SPILL_FILE,"a+b")
+			spillFile.write(b"%d\n" % len(payload))
+			spillFile.write(payload)
+			spillFile.flush()
+			spillPending+=1
+			overflow_counts["spilled"]+=1
+			return True
+		except OSError as e:
+			overflow_counts["dropped_newest"]+=1
+			logging.error("unable to write %s, message dropped. Error %s",SPILL_FILE,e)
+			return False
+
+#####################################
+#
+# unspillJobs(max_jobs)
+#
+# returns up to max_jobs payloads from the spill file in the order
+# they were written. The file is emptied once everything has been read
+#
+def unspillJobs(max_jobs):
+	global spillPending,spillOffset
+	jobs=[]
+	with spill_lock:
+		try:
+			spillFile.seek(spillOffset)
+			while spillPending>0 and len(jobs)<max_jobs:
+				size=int(spillFile.readline())
+				jobs.append(spillFile.read(size))
+				spillPending-=1
+			spillOffset=spillFile.tell()
+			if spillPending==0:
+				spillFile.truncate(0)
+				spillOffset=0
+		except (OSError,ValueError) as e:
+			# the rest of the file is unusable
+			logging.error("unable to read %s, %s spilled messages lost. Error %s",SPILL_FILE,spillPending,e)
+			overflow_counts["dropped_newest"]+=spillPending
+			spillPending=0
+			spillOffset=0
+			spillFile.truncate(0)
+	overflow_counts["unspilled"]+=len(jobs)
+	return jobs
+
+#####################################
+#
+# openSpillFile()
+#
+# called at startup, anything left in the spill file
+# by the last run is queued before new messages
+#
+def openSpillFile():
+	global spillFile,spillPending
+	if OVERFLOW_POLICY!="spill" or not os.path.exists(SPILL_FILE):
+		return
+	spillFile=open(SPILL_FILE,"a+b")
+	spillFile.seek(0)
+	while True:
+		line=spillFile.readline()
+		if not line:
+			break
+		try:
+			size=int(line)
+		except ValueError:
+			break
+		spillFile.seek(size,os.SEEK_CUR)
+		spillPending+=1
+	if spillPending>0:
+		logging.info("%s messages left in %s by the last run",spillPending,SPILL_FILE)
+	else:
+		spillFile.truncate(0)
+
+#####################################
+#
+# logStats()
+#
+# logs overflow_counts, rejected_counts, duplicate_counts, unknown_keys
+# and bad_values once a minute if they have changed
+#
+def logStats():
+	global lastOverflowCounts,lastRejectedCounts,lastDuplicateCounts,lastUnknownKeys,lastBadValues,nextStatsLog
+	nextStatsLog=time.time()+60
+	counts=dict(overflow_counts)
+	if counts!=lastOverflowCounts:
+		logging.warning("job_queue overflow policy=%s %s spill pending=%s",OVERFLOW_POLICY,counts,spillPending)
+		lastOverflowCounts=counts
+	counts=dict(copyCounts(rejected_counts))
+	if counts!=lastRejectedCounts:
+		logging.warning("messages not written %s",counts)
+		lastRejectedCounts=counts
+	counts=dict(copyCounts(duplicate_counts))
+	if counts!=lastDuplicateCounts:
+		logging.info("duplicate readings skipped %s",counts)
+		lastDuplicateCounts=counts
+	counts=dict(copyCounts(unknown_keys).most_common())
+	if counts!=lastUnknownKeys:
+		logging.info("unknown payload keys ignored %s",counts)
+		lastUnknownKeys=counts
+	counts=dict(copyCounts(bad_values).most_common())
+	if counts!=lastBadValues:
+		logging.info("payload values ignored, not numbers %s",counts)
+		lastBadValues=counts
+
+	for source,quantiles in sorted(lagQuantiles(source_lags).items()):
+		logging.info("ingest lag %s p50=%.0fs p90=%.0fs p99=%.0fs max=%.0fs",source,quantiles[0.5],quantiles[0.9],quantiles[0.99],quantiles["max"])
+		if quantiles[0.9]>LAG_WARN_SECS and source not in lagWarnings:
+			logging.warning("ingest lag for %s is over %ss, p90=%.0fs",source,LAG_WARN_SECS,quantiles[0.9])
+			lagWarnings.add(source)
+		elif quantiles[0.9]<=LAG_WARN_SECS and source in lagWarnings:
+			logging.warning("ingest lag for %s is back under %ss, p90=%.0fs",source,LAG_WARN_SECS,quantiles[0.9])
+			lagWarnings.discard(source)
 
 ################################
 #
@@ -514,6 +1831,12 @@ def on_subscribe(mqttc,obj,mid,granted_qos):
 #
 # connectToBroker
 #
+# creates the one paho client and connects it. Called once at startup,
+# after that paho's network loop reconnects by itself, the main loop only
+# waits for it (see waitForConnect()). A second client would fight the
+# first for the persistent session's client_id and ackJob() could ack
+# through the wrong connection
+#
 # on_connect sets a global flag brokerConnected
 def connectToBroker():
 	global mqttc,brokerConnected
@@ -523,12 +1846,18 @@ def connectToBroker():
 	logging.info("connectTobroker(): Trying to connect to the MQTT broker")
 	print("connectToBroker():Trying to connect to the MQTT broker")
 
-	mqttc = paho.Client()  # uses a random client id
+	if PERSISTENT_SESSION:
+		# the broker keeps our subscription and unacknowledged messages while we are away
+		mqttc = paho.Client(paho.CallbackAPIVersion.VERSION1, client_id=MQTT_CLIENT_ID, clean_session=False, manual_ack=True)
+	else:
+		mqttc = paho.Client()  # uses a random client id
 
 	mqttc.on_connect = on_connect
 	mqttc.on_subscribe = on_subscribe
 	mqttc.on_message = on_message
 	mqttc.on_disconnect = on_disconnect
+	# paho retries well within the time the main loop waits, see waitForConnect()
+	mqttc.reconnect_delay_set(min_delay=1, max_delay=max(1,mqttConnectTimeout//2))
 
 	# use authentication?
 	if mqttClientUser is not None:
@@ -540,36 +1869,63 @@ def connectToBroker():
 	# terminate if the connection takes too long
 	# on_connect sets a global flag brokerConnected
 	startConnect = time.time()
+	connectEvent.clear()
 	mqttc.loop_start()	# runs in the background, reconnects if needed
-	mqttc.connect(mqttBroker, keepalive=mqttKeepAlive)
+	mqttc.connect(mqttBroker, mqttPort, keepalive=mqttKeepAlive)
 
-	while not brokerConnected:
-		if (time.time() - startConnect) > mqttConnectTimeout:
-			logging.error("broker on_connect time out (%ss)", mqttConnectTimeout)
-			return False
+	if not waitForConnect(startConnect+mqttConnectTimeout):
+		logging.error("broker on_connect time out (%ss)", mqttConnectTimeout)
+		return False
 
 	logging.info("Connected to MQTT broker after %s s", int(time.time() - startConnect))
 	return True
 
+################################
+#
+# waitForConnect(deadline)
+#
+# sleeps until on_connect() reports a successful connection
+# or time.time() passes deadline. A refused connection (rc!=0)
+# is retried by paho so keep waiting for the next on_connect()
+#
+# returns brokerConnected
+#
+def waitForConnect(deadline):
+	while not brokerConnected:
+		remaining=deadline-time.time()
+		if remaining<=0 or not connectEvent.wait(remaining):
+			break
+		connectEvent.clear()
+	return brokerConnected
+
 ###################################
 #
 # connectToDatabase()
 #
-# attempt to connect to the database
+# attempt to create the connection pool, one connection for each
+# worker and one for the main thread
 # return True on success else False
 #
 def connectToDatabase():
-	global mydb,dbHost,dbUser,dbPassword,dbName
-	# open a database connection
+	global dbPool,dbHost,dbPort,dbUser,dbPassword,dbName
+	# open the database connections
 	try:
-		mydb = mysql.connector.connect(
+		dbPool = mysql.connector.pooling.MySQLConnectionPool(
+			pool_name="dbLoader",
+			pool_size=WORKERS+1,
 			host=dbHost,
+			port=dbPort,
 			user=dbUser,
 			passwd=dbPassword,
 			database=dbName
 		)
 
-		logging.info("connectToDatabase(): Opened a database connection ok.")
+		# the main thread's connection
+		worker.mydb=dbPool.get_connection()
+		worker.stmt_cursors={}
+		worker.stmt_connection_id=None
+
+		logging.info("connectToDatabase(): Opened %s database connections ok.",WORKERS+1)
 		return True
 
 	except Exception as e:
@@ -577,6 +1933,244 @@ def connectToDatabase():
 		return False
 
 
+#####################################
+#
+# backfill(path)
+#
+# --backfill, loads messages straight into the database instead of
+# receiving them from the broker. path is a newline delimited JSON file,
+# one payload per line (- reads stdin), or a spool folder. A spool must
+# not be in use by a running dbLoader, its checkpoint is moved on as
+# chunks are committed so dbLoader carries on after them
+#
+# messages are checked and mapped the same way as live ingest, see
+# backfillChunk(). Readings already in the database are skipped by the
+# unique key so a backfill which stops part way can be run again
+#
+# returns True if everything was read, False if the database failed
+#
+def backfill(path):
+	global mySpool
+	counts=collections.Counter()	# read, written, duplicates and rejections by reason
+	missing=set()					# device names not in the database
+	start=time.time()
+	progress=[start+BACKFILL_PROGRESS_SECS]
+
+	logging.info("backfill(): loading %s, %s messages per chunk",path,BACKFILL_CHUNK)
+	try:
+		if os.path.isdir(path):
+			mySpool=spool.Spool(path,SPOOL_SEGMENT_MB*1024*1024)
+			total=mySpool.pending()
+			while True:
+				records=mySpool.read(BACKFILL_CHUNK)
+				if len(records)==0:
+					break
+				backfillChunk([payload for seq,payload in records],counts,missing)
+				for seq,payload in records:
+					mySpool.done(seq)
+				mySpool.saveCheckpoint()
+				backfillProgress(counts,start,progress,counts["read"]/max(total,1))
+			mySpool.close()
+		else:
+			f=sys.stdin.buffer if path=="-" else open(path,"rb")
+			size=os.fstat(f.fileno()).st_size if path!="-" else 0
+			chunk=[]
+			for line in f:
+				line=line.strip()
+				if len(line)==0:
+					continue
+				chunk.append(line)
+				if len(chunk)>=BACKFILL_CHUNK:
+					backfillChunk(chunk,counts,missing)
+					chunk=[]
+					backfillProgress(counts,start,progress,f.tell()/size if size>0 else None)
+			if len(chunk)>0:
+				backfillChunk(chunk,counts,missing)
+			f.close()
+
+	except mysql.connector.Error as e:
+		logging.exception("backfill(): database error, stopped")
+		backfillProgress(counts,start,None,None)
+		print(f"backfill stopped by a database error: {e}")
+		return False
+
+	backfillProgress(counts,start,None,1.0)
+	if len(missing)>0:
+		logging.info("backfill(): devices not registered: %s",", ".join(sorted(str(name) for name in missing)))
+	counts=copyCounts(unknown_keys)
+	if len(counts)>0:
+		logging.info("backfill(): unknown payload keys ignored: %s",dict(counts.most_common(20)))
+	return True
+
+#####################################
+#
+# backfillProgress(counts,start,progress,done)
+#
+# prints and logs the counts every BACKFILL_PROGRESS_SECS, progress is
+# [next time] or None to print now. done is the fraction of the input
+# read, if known, for the time to go
+#
+def backfillProgress(counts,start,progress,done):
+	now=time.time()
+	if progress is not None:
+		if now<progress[0]:
+			return
+		progress[0]=now+BACKFILL_PROGRESS_SECS
+
+	elapsed=max(now-start,0.001)
+	rejected=sum(n for reason,n in counts.items() if reason not in ("read","written","duplicates"))
+	text=f"backfill: {counts['read']} messages read, {counts['written']} readings written, " \
+		f"{counts['duplicates']} duplicates, {rejected} rejected, {counts['read']/elapsed:.0f} msgs/s"
+	if done is not None and done>0:
+		text+=f", {100*done:.1f}% in {elapsed:.0f}s"
+		if done<1:
+			text+=f", about {elapsed*(1-done)/done:.0f}s to go"
+	if progress is None or done==1.0:
+		text+=". Rejected: "+(", ".join(f"{reason} {n}" for reason,n in counts.items() if reason not in ("read","written","duplicates")) or "none")
+	print(text,flush=True)
+	logging.info(text)
+
+#####################################
+#
+# backfillChunk(payloads,counts,missing)
+#
+# payloads is a list of message bytes. Each is decoded, its device looked
+# up and its keys mapped with mapPayload() as process_job() would. Messages
+# without a valid timestamp are rejected, "now" means nothing for old
+# readings. Repeats within the chunk are dropped
+#
+# the readings are sorted by recordedon then device_id, the order live
+# ingest adds them in, so new rows go on the end of the readings indexes
+# and a chunk of history touches as few index pages as possible. They are
+# written by writeBackfill() and committed once. If that fails the chunk
+# is split in half and each half tried again so one bad message (e.g. a
+# value which is not a number) only loses itself
+#
+# raises mysql.connector.Error if the database can't be used
+#
+def backfillChunk(payloads,counts,missing):
+	setBatchTime()
+	rows={}			# (recordedOn,device_id):(raw_json,(lat,lon,alt),values)
+
+	for payload in payloads:
+		counts["read"]+=1
+		try:
+			payloadJson=jsonCodec.loads(payload)
+		except Exception:
+			counts["bad_json"]+=1
+			continue
+		if not isinstance(payloadJson,dict):
+			counts["not_object"]+=1
+			continue
+		worker.payloadJson=payloadJson
+
+		device_name=payloadJson.get("dev")
+		if device_name is None:
+			counts["no_dev"]+=1
+			continue
+		device_id=devices_id.get(device_name)
+		if device_id is None and device_name not in missing:
+			device_id=getDeviceId(0)
+			if device_id is None:
+				missing.add(device_name)
+		if device_id is None:
+			counts["unknown_device"]+=1
+			continue
+
+		recordedOn=getRecordedOn(0)
+		if recordedOn is None:
+			counts["no_timestamp"]+=1
+			continue
+
+		key=(recordedOn,device_id)
+		if key in rows:
+			counts["duplicates"]+=1
+			continue
+		values,gnss=mapPayload(0)
+		rows[key]=(getRawJson(payload),gnss,values)
+
+	pieces=[sorted(rows)]
+	while len(pieces)>0:
+		keys=pieces.pop(0)
+		if len(keys)==0:
+			continue
+		try:
+			written=writeBackfill(rows,keys)
+			worker.mydb.commit()
+		except (mysql.connector.errors.InterfaceError,mysql.connector.errors.OperationalError):
+			raise
+		except mysql.connector.Error as e:
+			worker.mydb.rollback()
+			if len(keys)==1:
+				rejectLog.error("backfillChunk(): reading for device_id %s at %s not written. %s",keys[0][1],keys[0][0],e)
+				counts["failed"]+=1
+				continue
+			logging.error("backfillChunk(): %s readings rolled back, retrying in halves. %s",len(keys),e)
+			half=len(keys)//2
+			pieces[0:0]=[keys[:half],keys[half:]]
+			continue
+		counts["written"]+=written
+		counts["duplicates"]+=len(keys)-written
+
+#####################################
+#
+# writeBackfill(rows,keys)
+#
+# writes the readings for keys, BACKFILL_INSERT_ROWS per INSERT,
+# their reading_values and devices.last_seen. Nothing is committed
+#
+# the new readings ids are read back from the first id the INSERT
+# returned, within the readings' recordedon range, and matched to the
+# rows by (device_id,recordedon). recordedon is a TIMESTAMP which may not
+# read back as written in the hours the clocks change so both sides are
+# compared as UNIX_TIMESTAMP() seconds, the server converts the strings
+# the same way it did for the INSERT. Readings already in the database
+# are older than the first id so they never get more values
+#
+# returns the number of readings added
+#
+def writeBackfill(rows,keys):
+	mycursor=worker.mydb.cursor()
+	written=0
+	lastSeen={}
+	for n in range(0,len(keys),BACKFILL_INSERT_ROWS):
+		part=keys[n:n+BACKFILL_INSERT_ROWS]
+		params=[]
+		for recordedOn,device_id in part:
+			raw_json,(lat,lon,alt),values=rows[(recordedOn,device_id)]
+			params+=(recordedOn,device_id,raw_json,lat,lon,alt)
+		mycursor.execute(BACKFILL_READINGS_SQL % ",".join(["(now(),%s,%s,%s,%s,%s,%s)"]*len(part)),params)
+		if mycursor.rowcount<=0:
+			continue
+		written+=mycursor.rowcount
+		firstId=mycursor.lastrowid
+
+		recordedOns=sorted({recordedOn for recordedOn,device_id in part})
+		mycursor.execute("SELECT "+",".join(["UNIX_TIMESTAMP(%s)"]*len(recordedOns)),recordedOns)
+		seconds=dict(zip((int(s) for s in mycursor.fetchone()),recordedOns))
+
+		mycursor.execute("SELECT id,device_id,UNIX_TIMESTAMP(recordedon) FROM readings WHERE id>=%s AND recordedon BETWEEN %s AND %s",
+			(firstId,part[0][0],part[-1][0]))
+		wanted=set(part)
+		params=[]
+		for reading_id,device_id,s in mycursor.fetchall():
+			key=(seconds.get(int(s)),device_id)
+			if key not in wanted:
+				continue	# added by the live dbLoader meanwhile
+			for value,type_id in rows[key][2]:
+				params.append((reading_id,value,type_id))
+			if key[0]>lastSeen.get(device_id,""):
+				lastSeen[device_id]=key[0]
+
+		for v in range(0,len(params),BACKFILL_INSERT_ROWS*4):
+			values=params[v:v+BACKFILL_INSERT_ROWS*4]
+			mycursor.execute(getValuesSql(len(values)),[field for row in values for field in row])
+
+	# last_seen only moves forward, old readings must not hide newer ones
+	if len(lastSeen)>0:
+		mycursor.executemany(BACKFILL_LAST_SEEN_SQL,[(s,device_id,s) for device_id,s in lastSeen.items()])
+	return written
+
 #############################################################################
 #
 # main
@@ -585,36 +2179,88 @@ def connectToDatabase():
 
 
 if not connectToDatabase():
-	mqttc.loop_stop()
 	sys.exit()
 
-getTypeIds(0)	# if the database changes manually restart the dbLoader service
+getTypeIds(0)	# checkTypeIds() reloads these if the table changes
+getDeviceIds(0)	# new devices are added as they are seen
+
+if args.backfill:
+	sys.exit(0 if backfill(args.backfill) else 1)
+
+nextTypesCheck=time.time()+TYPES_CHECK_SECS
+if hasattr(signal,"SIGHUP"):
+	signal.signal(signal.SIGHUP, on_sighup)
+
+for n in range(WORKERS):
+	threading.Thread(target=dbWorker, args=(n,), name=f"dbWorker{n}", daemon=True).start()
+
+openSpillFile()
+nextStatsLog=time.time()+60
+
+if METRICS_ENABLED:
+	try:
+		metrics.start(METRICS_HOST,METRICS_PORT)
+	except OSError as e:
+		logging.error("Unable to serve metrics on %s:%s. %s",METRICS_HOST,METRICS_PORT,e)
+
+if SPOOL_ENABLED:
+	try:
+		mySpool=spool.Spool(SPOOL_DIR,SPOOL_SEGMENT_MB*1024*1024)
+	except Exception as e:
+		logging.exception("Unable to open the spool in %s",SPOOL_DIR)
+		sys.exit()
+	logging.info("spool %s opened, checkpoint %s, %s messages to load",SPOOL_DIR,mySpool.checkpoint,mySpool.pending())
 
 if not connectToBroker():
 	mqttc.loop_stop()
 	sys.exit()
 
-# main loop which retrieves jobs from the job_queue
-# and passes them to process_job()
+# main loop which waits for jobs on the job_queue
+# and passes them to the workers
 
 while True:
 	if not brokerConnected:
-		logging.info("Attempting to reconnect to broker")
-		if not connectToBroker():
+		logging.info("Waiting for paho to reconnect to the broker")
+		if not waitForConnect(time.time()+mqttConnectTimeout):
 			logging.info("main: unable to re-connect to broker")
 			mqttc.loop_stop()
+			if mySpool is not None:
+				mySpool.close()
 			sys.exit() # systemd will restart us
 
-	# anything to do?
-	if not job_queue.empty():
-		# make sure the dabase is alive and well
-		mydb.ping(reconnect=True, attempts=5, delay=1)
-		# TODO add code to check if the connection is really up
-		# retrieve the next job and process it
-		payload=job_queue.get()	# retrieve the next job
-		process_job(message_number,payload)
-		# bump the message number with wrap around
-		message_number=(message_number+1) % MAX_MESSAGE_NUMBER
-	else:
+	# reading_value_types changed or SIGHUP?
+	if reloadTypes or (TYPES_CHECK_SECS>0 and time.time()>=nextTypesCheck):
+		worker.mydb.ping(reconnect=True, attempts=5, delay=1)
+		checkTypeIds(message_number)
+
+	# devices.last_seen is updated every LAST_SEEN_SECS
+	if len(pending_last_seen)>0 and time.time()>=nextLastSeenFlush:
+		worker.mydb.ping(reconnect=True, attempts=5, delay=1)
+		flushLastSeen(message_number)
+
+	if time.time()>=nextStatsLog:
+		logStats()
+
+	# the spool is read in order, BATCH_SIZE at a time. dispatchJob() waits
+	# when the workers are busy
+	if mySpool is not None:
+		maintainSpool()
+		if mySpool.pending()>0:
+			dispatchSpooled()
+			continue
+
+	# spilled jobs are read back once the job_queue has been drained
+	if spillPending>0 and job_queue.empty():
+		for payload in unspillJobs(BATCH_SIZE):
+			dispatchJob(payload)
+		continue
+
+	# wait for something to do. on_disconnect() puts None on the
+	# queue to wake us up
+	try:
+		job=job_queue.get(timeout=mainLoopTimeout())
+	except queue.Empty:
+		continue
 
-		time.sleep(0.1)
+	if job is not None:
+		dispatchJob(*job)
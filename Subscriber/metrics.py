@@ -0,0 +1,278 @@
+"""
+metrics.py
+
+Author:     Brian Norman
+Date:       18/10/2026
+Version:    1.0
+Python Ver: 3
+
+Prometheus metrics for dbLoader. Only the python standard library is used.
+
+start() serves every metric created in Prometheus text format on http://host:port/metrics
+from a background thread. Until start() is called observe(), inc() and mark() return
+straight away so the metrics cost next to nothing when they are turned off.
+
+	Counter   - a count which only goes up, optionally split by one label
+	Meter     - a Counter (<name>_total) plus a <name>_per_second gauge averaged over
+	            the last few seconds
+	Histogram - latencies in seconds counted in buckets, optionally split by one label
+	Gauge     - a function called when the metrics are read e.g. job_queue.qsize
+
+USAGE:
+
+	import metrics
+
+	STAGE_SECONDS=metrics.Histogram("dbloader_stage_seconds","time spent in each stage","stage")
+	REJECTED=metrics.Counter("dbloader_rejected_total","messages not written","reason")
+	metrics.Gauge("dbloader_job_queue_depth","jobs waiting",job_queue.qsize)
+
+	metrics.start("127.0.0.1",9108)
+
+	start=time.perf_counter()
+	...
+	STAGE_SECONDS.observe("decode",time.perf_counter()-start)
+	REJECTED.inc("bad_json")
+
+"""
+
+import bisect
+import threading
+import time
+import logging
+import http.server
+
+# 100us to 10s, the stages range from a dictionary lookup to a commit
+DEFAULT_BUCKETS=(0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+enabled=False	# set by start()
+registry=[]		# every metric, in the order created
+
+#####################################
+#
+# formatLabel(labelName,label,extra="")
+#
+# returns {labelName="label",extra} or "" if there are no labels
+#
+# labelName can be a tuple of names, label is then a tuple of values
+#
+def formatLabel(labelName,label,extra=""):
+	labels=[]
+	if isinstance(labelName,tuple):
+		for name,value in zip(labelName,label):
+			labels.append('%s="%s"' % (name,escapeLabel(value)))
+	elif labelName is not None:
+		labels.append('%s="%s"' % (labelName,escapeLabel(label)))
+	if extra!="":
+		labels.append(extra)
+	if len(labels)==0:
+		return ""
+	return "{"+",".join(labels)+"}"
+
+def escapeLabel(value):
+	return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+def formatValue(value):
+	if value==float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value,float) else str(value)
+
+#####################################
+#
+# Counter(name,help,labelName=None)
+#
+# inc(label) adds to the count for label, inc() if there is no labelName
+#
+class Counter:
+
+	def __init__(self,name,help,labelName=None):
+		self.name=name
+		self.help=help
+		self.labelName=labelName
+		self.values={}
+		self.lock=threading.Lock()
+		registry.append(self)
+
+	def inc(self,label=None,amount=1):
+		if not enabled:
+			return
+		with self.lock:
+			self.values[label]=self.values.get(label,0)+amount
+
+	def render(self):
+		with self.lock:
+			values=dict(self.values)
+		lines=["# HELP %s %s" % (self.name,self.help),"# TYPE %s counter" % self.name]
+		if len(values)==0 and self.labelName is None:
+			values[None]=0
+		for label,value in values.items():
+			lines.append("%s%s %s" % (self.name,formatLabel(self.labelName,label),formatValue(value)))
+		return lines
+
+#####################################
+#
+# Meter(name,help,window=10)
+#
+# counts events and their rate. mark() adds to the count for the current
+# second, the rate is the average over the last window whole seconds
+#
+class Meter:
+
+	def __init__(self,name,help,window=10):
+		self.name=name
+		self.help=help
+		self.window=window
+		self.total=0
+		self.seconds={}		# int(time.time()):count
+		self.lock=threading.Lock()
+		registry.append(self)
+
+	def mark(self,amount=1):
+		if not enabled:
+			return
+		second=int(time.time())
+		with self.lock:
+			self.total+=amount
+			self.seconds[second]=self.seconds.get(second,0)+amount
+			if len(self.seconds)>self.window+1:
+				for s in [s for s in self.seconds if s<second-self.window]:
+					del self.seconds[s]
+
+	def perSecond(self):
+		now=int(time.time())
+		with self.lock:
+			count=sum(n for s,n in self.seconds.items() if now-self.window<=s<now)
+		return count/self.window
+
+	def render(self):
+		rate=self.perSecond()
+		with self.lock:
+			total=self.total
+		return ["# HELP %s_total %s" % (self.name,self.help),
+				"# TYPE %s_total counter" % self.name,
+				"%s_total %s" % (self.name,total),
+				"# HELP %s_per_second %s, average over the last %ss" % (self.name,self.help,self.window),
+				"# TYPE %s_per_second gauge" % self.name,
+				"%s_per_second %s" % (self.name,formatValue(rate))]
+
+#####################################
+#
+# Histogram(name,help,labelName=None,buckets=DEFAULT_BUCKETS)
+#
+# observe(label,seconds), or observe(seconds) if there is no labelName,
+# counts the value in the first bucket it fits in. render() adds them
+# up to give Prometheus' cumulative buckets
+#
+class Histogram:
+
+	def __init__(self,name,help,labelName=None,buckets=DEFAULT_BUCKETS):
+		self.name=name
+		self.help=help
+		self.labelName=labelName
+		self.buckets=tuple(buckets)
+		self.series={}		# label:[bucket counts...,+Inf count,sum]
+		self.lock=threading.Lock()
+		registry.append(self)
+
+	def observe(self,label,seconds=None):
+		if not enabled:
+			return
+		if self.labelName is None:
+			label,seconds=None,label
+		i=bisect.bisect_left(self.buckets,seconds)
+		with self.lock:
+			counts=self.series.get(label)
+			if counts is None:
+				counts=[0]*(len(self.buckets)+2)
+				self.series[label]=counts
+			counts[i]+=1
+			counts[-1]+=seconds
+
+	def render(self):
+		with self.lock:
+			series={label:list(counts) for label,counts in self.series.items()}
+		lines=["# HELP %s %s" % (self.name,self.help),"# TYPE %s histogram" % self.name]
+		for label,counts in series.items():
+			cumulative=0
+			for bound,count in zip(self.buckets+(float("inf"),),counts):
+				cumulative+=count
+				lines.append("%s_bucket%s %s" % (self.name,formatLabel(self.labelName,label,'le="%s"' % formatValue(bound)),cumulative))
+			lines.append("%s_sum%s %s" % (self.name,formatLabel(self.labelName,label),formatValue(counts[-1])))
+			lines.append("%s_count%s %s" % (self.name,formatLabel(self.labelName,label),cumulative))
+		return lines
+
+#####################################
+#
+# Gauge(name,help,function,labelName=None,type="gauge")
+#
+# function is called each time the metrics are read. With a labelName it
+# returns a dictionary label:value, with a tuple of label names the
+# dictionary keys are tuples too. type="counter" for counts kept
+# elsewhere e.g. dbLoader's overflow_counts
+#
+class Gauge:
+
+	def __init__(self,name,help,function,labelName=None,type="gauge"):
+		self.name=name
+		self.help=help
+		self.function=function
+		self.labelName=labelName
+		self.type=type
+		registry.append(self)
+
+	def render(self):
+		lines=["# HELP %s %s" % (self.name,self.help),"# TYPE %s %s" % (self.name,self.type)]
+		try:
+			values=self.function()
+		except Exception as e:
+			logging.error("metrics: unable to read %s. %s",self.name,e)
+			return lines
+		if self.labelName is None:
+			values={None:values}
+		for label,value in values.items():
+			lines.append("%s%s %s" % (self.name,formatLabel(self.labelName,label),formatValue(value)))
+		return lines
+
+#####################################
+#
+# render()
+#
+# returns every metric in Prometheus text format
+#
+def render():
+	lines=[]
+	for metric in registry:
+		lines+=metric.render()
+	return "\n".join(lines)+"\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split("?")[0]!="/metrics":
+			self.send_error(404)
+			return
+		body=render().encode("UTF-8")
+		self.send_response(200)
+		self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length",str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self,format,*args):
+		# every scrape would be logged otherwise
+		pass
+
+#####################################
+#
+# start(host,port)
+#
+# turns the metrics on and serves them on http://host:port/metrics
+# Raises OSError if the port can't be opened
+#
+def start(host,port):
+	global enabled
+	server=http.server.ThreadingHTTPServer((host,port),MetricsHandler)
+	server.daemon_threads=True
+	threading.Thread(target=server.serve_forever,name="metrics",daemon=True).start()
+	enabled=True
+	logging.info("metrics: serving http://%s:%s/metrics",host,port)
+	return server
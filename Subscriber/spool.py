@@ -0,0 +1,309 @@
+"""
+spool.py
+
+Author:     Brian Norman
+Date:       18/10/2026
+Version:    1.0
+Python Ver: 3
+
+Durable, append-only message spool used by dbLoader. on_message() appends each payload and
+the database workers read them back. Nothing is lost if dbLoader is restarted, crashes or
+the database is unavailable for a long time.
+
+The spool is a folder of segment files named spool-<first sequence number>.seg. Each record is
+
+	sequence number (8 bytes), payload length (4 bytes), crc32 of the payload (4 bytes), payload
+
+Segments are read back through mmap. When a segment reaches segment_bytes a new one is started.
+
+The checkpoint file holds the highest sequence number for which it, and every record before it,
+has been committed to the database (see done()). Segments wholly at or below the checkpoint are
+deleted by saveCheckpoint(). After a restart reading resumes at checkpoint+1 so records which were
+being written when dbLoader stopped are written again (at least once delivery).
+
+A record left half written by a crash fails its crc check and is discarded along with anything
+after it in that segment.
+
+USAGE:
+
+	import spool
+
+	mySpool=spool.Spool("/var/lib/dbLoader/spool")
+	seq=mySpool.append(payload)			# payload is bytes
+	for seq,payload in mySpool.read(50):
+		...
+		mySpool.done(seq)				# once the payload has been committed
+	mySpool.saveCheckpoint()			# every second or so
+
+"""
+
+import os
+import mmap
+import struct
+import threading
+import zlib
+import logging
+
+HEADER=struct.Struct("<QII")	# seq, length, crc32
+CHECKPOINT_FILE="checkpoint"
+
+class Spool:
+
+	#####################################
+	#
+	# __init__(directory,segment_bytes)
+	#
+	# opens (or creates) the spool in directory and recovers the
+	# read position from the checkpoint
+	#
+	def __init__(self,directory,segment_bytes=16*1024*1024):
+		self.directory=directory
+		self.segment_bytes=segment_bytes
+		self.lock=threading.Lock()
+
+		os.makedirs(directory,exist_ok=True)
+
+		self.checkpoint=self._loadCheckpoint()	# last seq committed, with everything before it
+		self.savedCheckpoint=self.checkpoint
+		self.completed=set()					# seqs done() out of order, above checkpoint
+
+		# segments in seq order, each is [first seq, path, size]
+		self.segments=[]
+		for name in os.listdir(directory):
+			if name.startswith("spool-") and name.endswith(".seg"):
+				path=os.path.join(directory,name)
+				self.segments.append([int(name[6:-4]),path,os.path.getsize(path)])
+		self.segments.sort()
+
+		self.nextSeq=self.checkpoint+1
+		if len(self.segments)>0:
+			self.nextSeq=max(self.nextSeq,self._recover(self.segments[-1]))
+
+		# the writer always appends to the last segment
+		self.writer=None
+		if len(self.segments)>0:
+			self.writer=open(self.segments[-1][1],"ab")
+
+		# reader position
+		self.readSeq=self.checkpoint+1
+		self.readSegment=0
+		self.readOffset=0
+		self.map=None
+		self._seekReader()
+
+		self.saveCheckpoint()
+
+	#####################################
+	#
+	# _loadCheckpoint()
+	#
+	# returns the saved checkpoint, 0 if there isn't one
+	#
+	def _loadCheckpoint(self):
+		try:
+			with open(os.path.join(self.directory,CHECKPOINT_FILE)) as f:
+				return int(f.read())
+		except FileNotFoundError:
+			return 0
+		except ValueError:
+			logging.error("Spool(): %s is corrupt, reading from the first record",CHECKPOINT_FILE)
+			return 0
+
+	#####################################
+	#
+	# _recover(segment)
+	#
+	# checks every record in the last segment and truncates it after
+	# the last good one
+	#
+	# returns the next seq to write
+	#
+	def _recover(self,segment):
+		firstSeq,path,size=segment
+		nextSeq=firstSeq
+		offset=0
+		if size>0:
+			with open(path,"rb") as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as m:
+				while offset+HEADER.size<=size:
+					seq,length,crc=HEADER.unpack_from(m,offset)
+					end=offset+HEADER.size+length
+					if end>size or zlib.crc32(m[offset+HEADER.size:end])!=crc:
+						break
+					nextSeq=seq+1
+					offset=end
+		if offset<size:
+			logging.error("Spool(): %s has %s bytes of incomplete records, discarded",path,size-offset)
+			with open(path,"r+b") as f:
+				f.truncate(offset)
+			segment[2]=offset
+		return nextSeq
+
+	#####################################
+	#
+	# _seekReader()
+	#
+	# finds the record readSeq
+	#
+	def _seekReader(self):
+		while self.readSegment+1<len(self.segments) and self.segments[self.readSegment+1][0]<=self.readSeq:
+			self.readSegment+=1
+		while self.readSegment<len(self.segments):
+			self._mapSegment()
+			size=self.segments[self.readSegment][2]
+			while self.readOffset+HEADER.size<=size:
+				seq,length,crc=HEADER.unpack_from(self.map,self.readOffset)
+				if seq>=self.readSeq:
+					return
+				self.readOffset+=HEADER.size+length
+			if self.readSegment+1==len(self.segments):
+				return
+			self._nextSegment()
+
+	#####################################
+	#
+	# _mapSegment()
+	#
+	# maps the reader's segment, or maps it again if it has grown
+	#
+	def _mapSegment(self):
+		size=self.segments[self.readSegment][2]
+		if self.map is not None and len(self.map)>=size:
+			return
+		if self.map is not None:
+			self.map.close()
+			self.map=None
+		if size>0:
+			with open(self.segments[self.readSegment][1],"rb") as f:
+				self.map=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+	def _nextSegment(self):
+		if self.map is not None:
+			self.map.close()
+			self.map=None
+		self.readSegment+=1
+		self.readOffset=0
+
+	#####################################
+	#
+	# append(payload)
+	#
+	# payload is bytes. The record is flushed to the operating system
+	# before returning so it survives dbLoader crashing. See sync()
+	#
+	# returns the record's seq
+	#
+	def append(self,payload):
+		with self.lock:
+			if self.writer is None or self.segments[-1][2]>=self.segment_bytes:
+				self._newSegment()
+			seq=self.nextSeq
+			self.writer.write(HEADER.pack(seq,len(payload),zlib.crc32(payload)))
+			self.writer.write(payload)
+			self.writer.flush()
+			self.segments[-1][2]+=HEADER.size+len(payload)
+			self.nextSeq+=1
+			return seq
+
+	def _newSegment(self):
+		if self.writer is not None:
+			os.fsync(self.writer.fileno())
+			self.writer.close()
+		path=os.path.join(self.directory,"spool-%020d.seg" % self.nextSeq)
+		self.writer=open(path,"ab")
+		self.segments.append([self.nextSeq,path,0])
+
+	#####################################
+	#
+	# pending()
+	#
+	# number of records appended but not yet read
+	#
+	def pending(self):
+		return self.nextSeq-self.readSeq
+
+	#####################################
+	#
+	# read(max_records)
+	#
+	# returns a list of up to max_records (seq,payload) tuples in the
+	# order they were appended
+	#
+	def read(self,max_records):
+		records=[]
+		with self.lock:
+			while len(records)<max_records and self.readSeq<self.nextSeq:
+				size=self.segments[self.readSegment][2]
+				if self.readOffset>=size:
+					self._nextSegment()
+					continue
+				self._mapSegment()
+				seq,length,crc=HEADER.unpack_from(self.map,self.readOffset)
+				start=self.readOffset+HEADER.size
+				records.append((seq,self.map[start:start+length]))
+				self.readOffset=start+length
+				self.readSeq=seq+1
+		return records
+
+	#####################################
+	#
+	# done(seq)
+	#
+	# the record has been dealt with (committed or rejected). Records
+	# can finish in any order, the checkpoint only moves past seq once
+	# everything before it is done too
+	#
+	def done(self,seq):
+		with self.lock:
+			if seq<=self.checkpoint:
+				return
+			self.completed.add(seq)
+			while self.checkpoint+1 in self.completed:
+				self.checkpoint+=1
+				self.completed.remove(self.checkpoint)
+
+	#####################################
+	#
+	# saveCheckpoint()
+	#
+	# writes the checkpoint file, if it has moved, and deletes
+	# segments which are no longer needed
+	#
+	def saveCheckpoint(self):
+		with self.lock:
+			checkpoint=self.checkpoint
+			if checkpoint!=self.savedCheckpoint:
+				path=os.path.join(self.directory,CHECKPOINT_FILE)
+				with open(path+".tmp","w") as f:
+					f.write(str(checkpoint))
+					f.flush()
+					os.fsync(f.fileno())
+				os.replace(path+".tmp",path)
+				self.savedCheckpoint=checkpoint
+
+			# a segment can go when the next one starts at or before checkpoint+1
+			# the writer's segment is always kept
+			while len(self.segments)>1 and self.segments[1][0]<=checkpoint+1 and self.readSegment>0:
+				os.remove(self.segments[0][1])
+				del self.segments[0]
+				self.readSegment-=1
+
+	#####################################
+	#
+	# sync()
+	#
+	# forces appended records to disk so they survive a power cut
+	#
+	def sync(self):
+		with self.lock:
+			if self.writer is not None:
+				os.fsync(self.writer.fileno())
+
+	def close(self):
+		self.saveCheckpoint()
+		with self.lock:
+			if self.map is not None:
+				self.map.close()
+				self.map=None
+			if self.writer is not None:
+				self.writer.close()
+				self.writer=None
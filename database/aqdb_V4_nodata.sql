@@ -165,6 +165,7 @@ CREATE TABLE `readings` (
   `reading_altitude` double DEFAULT NULL,
   `s_or_r` timestamp GENERATED ALWAYS AS (coalesce(`recordedon`,`storedon`)) STORED,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `device_recordedon_uq` (`device_id`,`recordedon`),
   KEY `device_id` (`device_id`),
   KEY `storedon_idx` (`storedon`),
   KEY `recordedon_idx` (`recordedon`),